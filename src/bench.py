@@ -0,0 +1,240 @@
+"""
+Microbenchmarks for the simulation, serialization and matchmaking hot paths. Run it from this directory, like main.py:
+
+    python bench.py --output before.json
+    python bench.py --compare before.json
+
+Results are written as JSON: one entry per benchmark and parameter set, each with a throughput in `value` (higher is
+better). With --compare, every result is checked against an earlier run and the exit code is 1 if anything got slower
+than --tolerance allows.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import tornado.ioloop
+
+import constants
+import game
+import main
+import matchmaking
+import protocol
+import threadmanager
+
+PLAYER_COUNTS = (2, 6, 10, 20)
+
+
+def measure(fn, min_time, repeats):
+    """
+    Call fn enough times to fill min_time, `repeats` times over.
+    :return: the best rate, in calls per second
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        number *= 2
+    number = max(1, int(number * min_time / 10 / elapsed))
+
+    best = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = max(best, number / (time.perf_counter() - start))
+    return best
+
+
+def make_game(players, g_id='bench', bots=False):
+    """
+    An initialized free-for-all game that never ends, so that every tick does the same amount of work.
+    """
+    random.seed(players)
+    inst = game.GameInstance(g_id)
+    for _ in range(players):
+        inst.create_team().create_player(bot=bots)
+    inst.init()
+    inst.is_over = lambda: False
+    return inst
+
+
+def bench_update(args):
+    for players in PLAYER_COUNTS:
+        inst = make_game(players)
+        yield {'players': players}, measure(lambda: inst.update(constants.GAME_UPDATE_PERIOD),
+                                            args.min_time, args.repeats), 'ticks/s'
+
+
+def bench_encode(args):
+    for players in PLAYER_COUNTS:
+        inst = make_game(players)
+        for _ in range(10):
+            inst.update(constants.GAME_UPDATE_PERIOD)
+        baseline = inst.snapshot
+        inst.update(constants.GAME_UPDATE_PERIOD)
+
+        yield ({'players': players, 'format': 'get_encoded+json'},
+               measure(lambda: json.dumps(inst.get_encoded()), args.min_time, args.repeats), 'frames/s')
+        yield ({'players': players, 'format': 'snapshot'},
+               measure(inst.get_snapshot, args.min_time, args.repeats), 'frames/s')
+        for fmt in protocol.FORMATS:
+            yield ({'players': players, 'format': fmt},
+                   measure(lambda: protocol.encode(inst.snapshot, fmt), args.min_time, args.repeats), 'frames/s')
+            yield ({'players': players, 'format': fmt + '+delta'},
+                   measure(lambda: protocol.encode(inst.snapshot, fmt, baseline), args.min_time, args.repeats),
+                   'frames/s')
+
+
+def bench_setup(args):
+    pool = game.GamePool(1)
+    for players in PLAYER_COUNTS:
+        def setup():
+            inst = game.GameInstance('bench')
+            team = inst.create_team()
+            for _ in range(players):
+                team.create_player()
+            inst.init()
+
+        def setup_pooled():  # Includes the reset that puts the game back
+            inst = pool.take('bench', players)
+            team = inst.create_team()
+            for _ in range(players):
+                team.create_player()
+            inst.init()
+            pool.recycle(inst)
+
+        yield {'players': players}, measure(setup, args.min_time, args.repeats), 'games/s'
+        yield {'players': players, 'pooled': True}, measure(setup_pooled, args.min_time, args.repeats), 'games/s'
+
+
+class IdleCluster(threadmanager.RoomCluster):
+    """
+    A cluster that never runs, so that games created by the matchmaking benchmark are not simulated.
+    """
+
+    def start(self):
+        pass
+
+    def remove_instance(self, game_instance):
+        self.games.remove(game_instance)  # Right away, as there are no ticks to do it between
+        self.pool.recycle(game_instance)
+
+
+class NullSocket:
+
+    def on_enough_players(self, token):
+        pass
+
+
+def bench_matchmaking(args):
+    for gamemode in main.GAMEMODES:
+        for depth in (100, 10000):
+            manager = main.GameManager([gamemode])
+            manager.thread_man = threadmanager.ThreadsManager(1, sys.maxsize, constants.GAME_UPDATE_PERIOD,
+                                                              IdleCluster)
+            mmer = manager.mmers[0]
+
+            def fill():
+                if mmer.player_count() < gamemode.total_players:
+                    for _ in range(depth):  # Queued directly, so that this does not measure queue notifications
+                        mmer.players.put(matchmaking.LobbyPlayer(NullSocket(), constants.ID_LENGTH))
+                mmer.fill_game()
+                # Remove what was created, so that placement does not slow down with every game so far
+                for game_id in list(manager.broadcasters):
+                    manager.thread_man.remove_game(game_id)
+                    del manager.broadcasters[game_id]
+                    del manager.initializers[game_id]
+
+            yield {'gamemode': gamemode.code, 'depth': depth}, measure(fill, args.min_time, args.repeats), 'games/s'
+
+
+def bench_cluster(args):
+    for games, players in ((10, 2), (10, 6), (5, 10), (10, 10)):
+        for bots in (False, True):
+            cluster = IdleCluster(games, constants.GAME_UPDATE_PERIOD)
+            for i in range(games):
+                cluster.games.append(make_game(players, 'bench{}'.format(i), bots))
+            params = {'games': games, 'players': players, 'bots': bots}
+            yield params, measure(cluster.tick, args.min_time, args.repeats), 'ticks/s'
+
+
+BENCHMARKS = {
+    'update': bench_update,
+    'encode': bench_encode,
+    'setup': bench_setup,
+    'matchmaking': bench_matchmaking,
+    'cluster': bench_cluster,
+}
+
+
+def result_key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline_file, tolerance):
+    """
+    Print how each result changed since a baseline run.
+    :return: True if nothing regressed by more than tolerance
+    """
+    with open(baseline_file) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    ok = True
+    for r in results:
+        old = baseline.get(result_key(r))
+        if old is None:
+            continue
+        change = r['value'] / old['value'] - 1
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print('{:12} {:48} {:>12.1f} -> {:>12.1f} {:+7.1%}{}'.format(
+            r['benchmark'], result_key(r)[1], old['value'], r['value'], change, '  REGRESSION' if regressed else ''),
+            file=sys.stderr)
+    return ok
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', choices=[[]] + list(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds per repeat')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', help='an earlier --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown when comparing')
+    args = parser.parse_args(argv)
+
+    tornado.ioloop.IOLoop.current()  # Matchmakers schedule callbacks on it, although it never runs here
+
+    results = []
+    for name in args.benchmarks or BENCHMARKS:
+        for params, value, unit in BENCHMARKS[name](args):
+            result = {'benchmark': name, 'params': params, 'value': value, 'unit': unit}
+            print('{:12} {:48} {:>12.1f} {}'.format(name, json.dumps(params, sort_keys=True), value, unit),
+                  file=sys.stderr)
+            results.append(result)
+
+    document = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
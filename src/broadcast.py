@@ -0,0 +1,131 @@
+"""
+The code that sends game state out to the clients in each game.
+"""
+import collections
+import logging
+import time
+
+import tornado.ioloop
+from tornado import websocket
+
+import constants
+import metrics
+import protocol
+
+log = logging.getLogger(__name__)
+
+encode_times = metrics.Histogram()  # Per message encoded
+send_times = metrics.Histogram()  # Per message handed to a socket
+
+
+class GameBroadcaster:
+    """
+    Encodes the state of a single game once per transmission period and hands the same message to every socket that
+    is subscribed to that game.
+    """
+
+    def __init__(self, inst, period, history_length=constants.DELTA_HISTORY):
+        """
+        :param inst: the game instance to broadcast
+        :param period: delay between transmissions in milliseconds
+        :param history_length: how many recent snapshots to keep as baselines for delta frames
+        """
+        self.inst = inst
+        self.period = period
+        self.sockets = set()
+        self.history_length = history_length
+        self.history = collections.OrderedDict()  # frame number -> snapshot, oldest first
+        self.created = time.monotonic()
+        self.abandoned = False  # Set once everyone who joined has left
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(self.broadcast, self.period)
+
+    def __repr__(self):
+        return 'GameBroadcaster({})'.format(self.inst.id)
+
+    def subscribe(self, socket):
+        """
+        Start sending frames to a socket. The broadcast task is started with the first subscriber.
+        :param socket: a GamePlayerConnection
+        :return:
+        """
+        self.sockets.add(socket)
+        if not self._periodic_callback.is_running():
+            log.debug('starting %s', self)
+            self._periodic_callback.start()
+
+    def unsubscribe(self, socket):
+        """
+        Stop sending frames to a socket. The broadcast task is stopped once nobody is listening.
+        :param socket: a GamePlayerConnection
+        :return:
+        """
+        self.sockets.discard(socket)
+        if not self.sockets and self._periodic_callback.is_running():
+            log.debug('stopping %s', self)
+            self._periodic_callback.stop()
+            self.abandoned = True
+
+    def close(self, reason):
+        """
+        Send the final state of the game to everyone, then disconnect them.
+        :param reason: sent to the clients as the close reason
+        :return:
+        """
+        if self.sockets:
+            self.broadcast()
+        for socket in list(self.sockets):
+            socket.close(1000, reason)
+        self.sockets.clear()
+        self._periodic_callback.stop()
+
+    def baseline_for(self, socket, snapshot):
+        """
+        Find the snapshot that a socket's delta frames should be relative to. Clients keep the last history_length
+        frame numbers' worth of baselines, so acks older than that get a keyframe even if we still have the snapshot.
+        :return: the snapshot, or None if the socket needs a full keyframe
+        """
+        if not socket.delta or socket.acked_frame is None:
+            return None
+        if snapshot.frames - socket.acked_frame >= self.history_length:
+            return None
+        return self.history.get(socket.acked_frame)
+
+    def broadcast(self):
+        snapshot = self.inst.snapshot  # Only ever read the published snapshot, the simulation thread owns the rest
+        self.history[snapshot.frames] = snapshot
+        while len(self.history) > self.history_length:
+            self.history.popitem(last=False)
+
+        messages = {}  # Encode once per wire format and baseline for everybody
+        for socket in list(self.sockets):
+            if socket.wants_frame():  # Sockets that are behind skip frames, and are not encoded for
+                self.send(socket, snapshot, messages)
+
+    def send_latest(self, socket):
+        """
+        Send the newest broadcast snapshot to a socket that skipped it, once it has caught up.
+        """
+        if self.history:
+            self.send(socket, next(reversed(self.history.values())), {})
+
+    def send(self, socket, snapshot, messages):
+        """
+        Send a snapshot to one socket.
+        :param messages: a cache of encoded messages for this snapshot, by wire format and baseline frame
+        """
+        fmt = socket.wire_format
+        baseline = self.baseline_for(socket, snapshot)
+        key = fmt, None if baseline is None else baseline.frames
+        try:
+            message = messages[key]
+        except KeyError:
+            start = time.perf_counter()
+            message = messages[key] = protocol.encode(snapshot, fmt, baseline)
+            encode_times.observe(time.perf_counter() - start)
+        try:
+            start = time.perf_counter()
+            socket.send_frame(message, fmt == protocol.BINARY)
+            send_times.observe(time.perf_counter() - start)
+        except websocket.WebSocketClosedError:
+            log.debug('%s lost a socket', self)
+            self.unsubscribe(socket)
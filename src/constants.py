@@ -4,18 +4,53 @@ import os
 TIMEOUT = 10  # NYI
 
 # Matchmaking Parameters
-MM_UPDATE_PERIOD = 1000
 ID_LENGTH = 16
+QUEUE_STATUS_DELAY = 0.1  # Seconds to wait for more queue changes before sending out the count
+BOT_BACKFILL_DELAY = 15  # Seconds before queued players get a game filled up with bots, or None to never do so
+READY_TIMEOUT = 30  # Seconds a new game waits for all of its players to connect before it is abandoned
+TOKEN_TTL = 60  # Seconds a match token can be used to join its game for
+
+# Routing between nodes
+ROUTER_POLL_PERIOD = 1000  # How often the router reads the load of its nodes
+ROUTER_REQUEST_TIMEOUT = 5  # Seconds the router waits on a node before giving up on it
+REQUEST_MAX_AGE = 10  # Seconds a signed request from a router is accepted for, its nonce is remembered as long
+
+# Game lifecycle
+REAP_PERIOD = 1000  # How often to look for games that are over
 
 # Misc
 DEV_TOKEN = 'horscho'
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples when profiling
+PROFILE_MAX_DURATION = 60
 
 # Environment Variables
 DEBUG_MODE = bool(int(os.environ.get('DEBUG', 0)))
 PORT = int(os.environ.get('PORT', 8080))
+CLUSTER_BACKEND = os.environ.get('CLUSTER_BACKEND', 'thread')  # 'thread' or 'process'
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '')  # Shared by a router and its nodes. Random per process if unset
+NODE_URL = os.environ.get('NODE_URL', '')  # How clients reach us, e.g. http://host:8081, or empty for the page's host
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')  # Needed to use the /admin endpoints, which are off if it is unset
 
 # Client transmission
 GAME_TRANSMISSION_PERIOD = 50  # The rate to send messages at
+CLIENT_INPUT_PERIOD = 100  # The rate clients send input at, INPUT_PERIOD in static/js/game.js
+INPUT_RATE_LIMIT = 30  # Messages per second a game client may send on average, the rest are dropped unread
+INPUT_BURST = 10  # Messages a game client may send back to back
+SEND_STALL_TIMEOUT = 10  # Seconds a game client may take to accept a frame before it is disconnected
+MAX_FRAME_INTERVAL = 1.0  # Slowest rate, in seconds per frame, that frames are sent at to a client on a slow link
+DELTA_HISTORY = 32  # How many frame numbers back a delta's baseline may be, HISTORY_LENGTH in static/js/game.js
 
 # Game
 GAME_UPDATE_PERIOD = 0.025
+MAX_CATCHUP_TICKS = 5  # Most ticks a lagging cluster runs back to back before giving up on the backlog
+
+# Game placement
+BODY_TICK_COST = 0.0001  # Guess at seconds of tick time per player, used until a cluster has measurements
+CLUSTER_LOAD_TARGET = 0.5  # Fraction of the tick budget a cluster should use before we prefer a new one
+CLUSTER_OVERLOAD = 0.9  # Fraction of the tick budget past which a cluster sheds games to others
+REBALANCE_PERIOD = 5000
+MAX_PLAYERS_PER_GAME = 16
+GAME_POOL_PREWARM = 2  # Idle games a cluster builds when it starts, each with trucks for MAX_PLAYERS_PER_GAME
+
+# Process clusters
+SNAPSHOT_RING_DEPTH = 4  # How many snapshots of each game are kept in shared memory
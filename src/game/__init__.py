@@ -1,2 +1,3 @@
-from .game import GameInstance, Team, Player
+from .game import GameInstance, GamePool, Team, Player, PlayerStore, PlayerState, Snapshot, apply_forces, \
+    apply_inputs, steer_bots
 from .constants import *
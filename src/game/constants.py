@@ -1,5 +1,13 @@
 PLAYER_ID_LENGTH = 16
 
+# Match rules
+MATCH_DURATION = 180  # Seconds of simulated time before a match ends regardless of who is alive
+
+# Bots
+BOT_THINK_FRAMES = 4  # Frames between a bot's steering decisions
+BOT_BOOST_RANGE = 150  # Bots boost at targets closer than this
+BOT_WALL_MARGIN = 40  # Bots this close to a wall turn back towards the middle
+
 # Physics parameters
 BOOST_DURATION = 1.5
 BOOST_COOLDOWN = 5
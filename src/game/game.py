@@ -1,12 +1,14 @@
 """Code that runs the actual game itself. It should be independent from the graphics, client-server interface, and
 matchmaking as much as possible. """
+import itertools
 import math
 import random
 import time
+from array import array
 
 import logging
 import pymunk
-from pymunk import Vec2d
+from collections import deque, namedtuple
 from typing import List, Iterable
 
 import util
@@ -16,34 +18,152 @@ from .constants import *
 log = logging.getLogger(__name__)
 
 
+class PlayerState(namedtuple('PlayerState', ['slot', 'id', 'team', 'living', 'x', 'y', 'direction', 'boosting',
+                                             'boost_level'])):
+    """
+    The state of a single player at one point in time
+    """
+    __slots__ = ()
+
+    def get_encoded(self):
+        return {
+            'id': self.id,
+            'x': self.x,
+            'y': self.y,
+            'living': self.living,
+            'direction': self.direction,
+            'isBoosting': self.boosting,
+            'boostLevel': self.boost_level,
+        }
+
+
+class Snapshot(namedtuple('Snapshot', ['frames', 'players', 'events', 'finished'])):
+    """
+    The state of a whole game at one point in time. Players are ordered by team. Snapshots are immutable, so they can be
+    read from any thread.
+    """
+    __slots__ = ()
+
+    def get_encoded(self):
+        return {
+            'frames': self.frames,
+            'teams': [
+                {
+                    'id': team_id,
+                    'players': [p.get_encoded() for p in players]
+                } for team_id, players in itertools.groupby(self.players, lambda p: p.team)
+            ],
+            'events': list(self.events),
+        }
+
+
+def boost_state(began_boost, now):
+    """
+    :return: whether a player who began boosting at began_boost is boosting at now, and their boost level
+    """
+    if began_boost + BOOST_DURATION > now:
+        return True, 1 - min(1.0, (now - began_boost) / BOOST_DURATION)
+    return False, min(1.0, (now - (began_boost + BOOST_DURATION)) / BOOST_COOLDOWN)
+
+
+class PlayerStore:
+    """
+    The per-player state of a game, in columns indexed by slot, so that the loops over every player read flat arrays
+    instead of attributes of many objects. Player objects are views of a row.
+    """
+    __slots__ = ('players', 'ids', 'index', 'bodies', 'teams', 'team_index', 'living', 'began_boost', 'braking',
+                 'order')
+
+    def __init__(self):
+        self.players = []
+        self.ids = []
+        self.index = {}  # player id -> slot
+        self.bodies = []
+        self.teams = []
+        self.team_index = array('H')  # Index of each player's team in GameInstance.teams
+        self.living = array('B')
+        self.began_boost = array('d')  # In simulated seconds, as GameInstance.elapsed
+        self.braking = array('B')
+        self.order = []  # Slots ordered by team, the order snapshots list players in
+
+    def __len__(self):
+        return len(self.players)
+
+    def add(self, player, team_index, living=True) -> int:
+        """
+        Add a row for a player.
+        :return: its slot
+        """
+        slot = len(self.players)
+        self.players.append(player)
+        self.ids.append(player.id)
+        self.index[player.id] = slot
+        self.bodies.append(player.body)
+        self.teams.append(player.team)
+        self.team_index.append(team_index)
+        self.living.append(living)
+        self.began_boost.append(-math.inf)
+        self.braking.append(False)
+        self.order = sorted(range(len(self.players)), key=self.team_index.__getitem__)
+        return slot
+
+
 class Player:
     """
-    A single player, dead or alive
+    A single player, dead or alive. Most of its state is kept in its game's PlayerStore.
     """
+    __slots__ = ('id', 'slot', 'body', 'team', 'ready', 'bot', 'input', 'applied_input', '_store')
 
-    def __init__(self, player_id: str, body: pymunk.Body, team, living=True, ready=False):
+    def __init__(self, player_id: str, body: pymunk.Body, team, living=True, ready=False, bot=False):
         self.id = player_id
         self.body = body
         self.team: Team = team
-        self.living = living
-        self.ready = ready
+        self.ready = ready or bot  # Bots have no connection to wait for
+        self.bot = bot  # Steered by steer_bots instead of a client
+        self._store: PlayerStore = team.game.store
+        self.slot = self._store.add(self, team.game.teams.index(team), living)  # Also identifies us on the wire
 
-        self.began_boost = 0
-        self.braking = False
+        # The latest rotation the client asked for, as (sequence number, rotation). It is replaced whole, so the network
+        # thread can write it while the simulation thread reads it, and apply_inputs uses it once per tick at most.
+        self.input = (0, None)
+        self.applied_input = 0
 
     def __repr__(self):
-        return 'Player(id={}, living={}, team={})'.format(self.id, self.living, self.team.id)
+        return '{}(id={}, living={}, team={})'.format('Bot' if self.bot else 'Player', self.id, self.living,
+                                                      self.team.id)
     
+    def get_state(self) -> PlayerState:
+        pos = self.pos
+        boosting, boost_level = boost_state(self.began_boost, self.team.game.elapsed)
+        return PlayerState(self.slot, self.id, self.team.id, self.living, pos.x, pos.y, self.rotation, boosting,
+                           boost_level)
+
+    @property
+    def living(self):
+        return bool(self._store.living[self.slot])
+
+    @living.setter
+    def living(self, val):
+        self._store.living[self.slot] = val
+
+    @property
+    def began_boost(self):
+        return self._store.began_boost[self.slot]
+
+    @began_boost.setter
+    def began_boost(self, val):
+        self._store.began_boost[self.slot] = val
+
+    @property
+    def braking(self):
+        return bool(self._store.braking[self.slot])
+
+    @braking.setter
+    def braking(self, val):
+        self._store.braking[self.slot] = val
+
     def get_encoded(self):
-        return {
-            'id': self.id,
-            'x': self.pos.x,
-            'y': self.pos.y,
-            'living': self.living,
-            'direction': self.rotation,
-            'isBoosting': self.is_boosting(),
-            'boostLevel': self.get_boost_level(),
-        }
+        return self.get_state().get_encoded()
 
     @property
     def pos(self):
@@ -54,13 +174,16 @@ class Player:
         self.body.position = val
 
     def is_boosting(self):
-        return self.began_boost + BOOST_DURATION > time.time()
+        return boost_state(self.began_boost, self.team.game.elapsed)[0]
 
     def get_boost_level(self):
-        if self.is_boosting():
-            return 1 - min(1.0, (time.time() - self.began_boost) / BOOST_DURATION)
-        else:
-            return min(1.0, (time.time() - (self.began_boost + BOOST_DURATION)) / BOOST_COOLDOWN)
+        return boost_state(self.began_boost, self.team.game.elapsed)[1]
+
+    def set_input(self, rotation):
+        """
+        Ask for a new rotation, to be applied at the start of the next tick. Only the newest one counts.
+        """
+        self.input = self.input[0] + 1, rotation
 
     @property
     def rotation(self):
@@ -93,38 +216,52 @@ class Team:
             'players': [p.get_encoded() for p in self]
         }
 
-    def create_player(self) -> Player:
-        # Create the body
-        body = pymunk.Body(PLAYER_MASS, 1666)
-
-        # Build the shapes
-        front_physical = pymunk.Poly(body,
-                                     util.offset_box(TRUCK_PLOW_LENGTH / 2 - TRUCK_BODY_SPACING / 2, 0,
-                                                     TRUCK_PLOW_LENGTH,
-                                                     TRUCK_PLOW_WIDTH), radius=2.0)
-        front_physical.elasticity = 1.5
-        front_physical.collision_type = TRUCK_PLOW_TYPE
-
-        back_physical = pymunk.Poly(body, util.offset_box(-TRUCK_BODY_LENGTH / 2 - TRUCK_BODY_SPACING / 2, 0,
-                                                          TRUCK_BODY_LENGTH - TRUCK_BODY_SPACING, TRUCK_BODY_WIDTH),
-                                    radius=2.0)
-        back_physical.elasticity = 5.0
-        back_physical.collision_type = TRUCK_CORE_TYPE
+    def create_player(self, player_id=None, bot=False) -> Player:
+        # Take a body and its shapes, built beforehand if the game came from a GamePool
+        body, front_physical, back_physical = self.game.take_truck()
 
         body.position = ARENA_WIDTH * random.random(), ARENA_HEIGHT * random.random()
         body.angle = 2 * math.pi * random.random()
 
-        player_id = util.random_string(PLAYER_ID_LENGTH)
+        if player_id is None:
+            player_id = util.random_string(PLAYER_ID_LENGTH)
 
         # Add the player to the things
         self.game.space.add(body, front_physical, back_physical)
-        player = Player(player_id, body, self)
+        self.game.trucks.append((body, front_physical, back_physical))  # Indexed by slot, like the store
+        player = Player(player_id, body, self, bot=bot)
         self.players.append(player)
+        if bot:
+            self.game.bots.append(player)
         body.player = player
+        self.game.publish()
 
         return player
 
 
+def build_truck():
+    """
+    Build the body of a player and its shapes, the plow in front and the core behind.
+    :return: (body, front shape, back shape)
+    """
+    body = pymunk.Body(PLAYER_MASS, 1666)
+
+    front_physical = pymunk.Poly(body,
+                                 util.offset_box(TRUCK_PLOW_LENGTH / 2 - TRUCK_BODY_SPACING / 2, 0,
+                                                 TRUCK_PLOW_LENGTH,
+                                                 TRUCK_PLOW_WIDTH), radius=2.0)
+    front_physical.elasticity = 1.5
+    front_physical.collision_type = TRUCK_PLOW_TYPE
+
+    back_physical = pymunk.Poly(body, util.offset_box(-TRUCK_BODY_LENGTH / 2 - TRUCK_BODY_SPACING / 2, 0,
+                                                      TRUCK_BODY_LENGTH - TRUCK_BODY_SPACING, TRUCK_BODY_WIDTH),
+                                radius=2.0)
+    back_physical.elasticity = 5.0
+    back_physical.collision_type = TRUCK_CORE_TYPE
+
+    return body, front_physical, back_physical
+
+
 class GameInstance:
     """
     A single instance of the game. Only handles game updates and stuff. Nothing else. After all, we don't want a god
@@ -133,16 +270,31 @@ class GameInstance:
 
     def __init__(self, g_id):
         self.teams = []
+        self.bots = []
         self.events = []
         self.space = pymunk.Space()
         self.frames = 0
+        self.elapsed = 0.0  # Simulated seconds. This is the game's only clock, it advances with step()
         self.id = g_id
+        self.store = PlayerStore()
+        self.trucks = []  # (body, front shape, back shape) of each slot
+        self.spare_trucks = []  # Built, but not in the space. create_player takes from here first
+
+        # Timing of step(), in seconds
+        self.last_physics_time = 0.0  # Spent in space.step on the last frame
+        self.mean_physics_time = 0.0  # Moving average of last_physics_time
+        self.mean_step_time = 0.0  # Moving average of the whole of step()
 
         self.initialized = False
+        self.finished = False
+
+        self.snapshot = self.get_snapshot()  # The latest published state, for readers on other threads
 
         # Listeners
         self.on_death = lambda p: None
 
+        self.build_arena()
+
     @property
     def players(self) -> Iterable[Player]:
         for t in self.teams:
@@ -150,18 +302,28 @@ class GameInstance:
                 yield p
 
     def player_with_id(self, p_id):
-        for p in self.players:
-            if p.id == p_id:
-                return p
-        return None
+        slot = self.store.index.get(p_id)
+        return None if slot is None else self.store.players[slot]
 
-    def players_ready(self):
-        return all(p.ready for p in self.players)
-
-    def init(self):
-
-        log.debug('%s initializing', self.id)
+    @property
+    def slot_count(self):
+        return len(self.store)
 
+    def players_ready(self):
+        return all(p.ready for p in self.store.players)
+
+    def is_over(self):
+        """
+        The match is over once at most one team has anyone alive, or after MATCH_DURATION.
+        """
+        living_teams = len({team for team, living in zip(self.store.team_index, self.store.living) if living})
+        return (len(self.teams) > 1 and living_teams <= 1) or self.elapsed >= MATCH_DURATION
+
+    def build_arena(self):
+        """
+        Add the collision handlers and the borders to the space. This is only done once per space, as they survive
+        reset().
+        """
         # Create collision handlers...
         # Between a plow and a truck body
         pb_handler = self.space.add_collision_handler(TRUCK_PLOW_TYPE, TRUCK_CORE_TYPE)
@@ -205,66 +367,319 @@ class GameInstance:
             s.collision_type = ARENA_BORDER_TYPE
         self.space.add(border_body, *border_shapes)
 
+    def init(self):
+        log.debug('%s initializing', self.id)
+        self.publish()  # Before the cluster thread can start stepping us, as this runs on the IOLoop
         self.initialized = True
 
+    def take_truck(self):
+        """
+        :return: a spare (body, front shape, back shape), or a new one if there are none
+        """
+        return self.spare_trucks.pop() if self.spare_trucks else build_truck()
+
+    def reserve(self, count):
+        """
+        Build spare trucks until there are enough for count players.
+        """
+        while len(self.spare_trucks) < count:
+            self.spare_trucks.append(build_truck())
+
+    def reset(self):
+        """
+        Take everything out of a game that is no longer being run, so that it can be set up again like a new one. The
+        space, its arena and its handlers are kept, and the players' bodies become spare trucks.
+        """
+        log.debug('%s resetting', self.id)
+        for body, front_physical, back_physical in self.trucks:
+            self.space.remove(body, front_physical, back_physical)
+            body.player = None
+            body.velocity = 0, 0
+            body.angular_velocity = 0
+            front_physical.collision_type = TRUCK_PLOW_TYPE  # Dead players' shapes were changed to DEAD_BODY_TYPE
+            back_physical.collision_type = TRUCK_CORE_TYPE
+        self.spare_trucks.extend(self.trucks)
+        self.trucks = []
+
+        # New containers rather than cleared ones, so that anyone still holding an old Player cannot touch the new game
+        self.teams = []
+        self.bots = []
+        self.events = []
+        self.store = PlayerStore()
+        self.frames = 0
+        self.elapsed = 0.0
+        self.last_physics_time = 0.0
+        self.mean_physics_time = 0.0
+        self.mean_step_time = 0.0
+        self.initialized = False
+        self.finished = False
+        self.on_death = lambda p: None
+        self.publish()
+
+    @property
+    def running(self):
+        return self.initialized and not self.finished
+
     def update(self, dt):
 
         if not self.initialized:
             log.debug('%s not initialized', self)
             return None
+        if self.finished:
+            return None
 
-        for p in self.players:  # Push the players along in their proper directions at their proper speeds.
-            force = (BOOST_FORCE if p.is_boosting() else NORMAL_FORCE) * Vec2d.unit()
-            force.angle = p.rotation
-            if p.living:
-                p.body.velocity += force / p.body.mass
-                p.body.angular_velocity = 0
-
-        for body in self.space.bodies:  # Apply friction
-            speed = body.velocity.get_length()
-            if speed > 0:
-                fric_dir = -body.velocity.normalized()
-                fric_amount = body.mass * FRICTION
-                friction_force = fric_dir * fric_amount * dt
-                if speed < MIN_SPEED:
-                    body.velocity = Vec2d.zero()
-                else:
-                    body.velocity += friction_force / body.mass
-            if body.velocity.get_length() > MAX_SPEED:
-                if not body.player.living:
-                    max_speed = DEAD_MAX_SPEED
-                elif body.player.is_boosting():
-                    max_speed = BOOST_MAX_SPEED
-                elif body.player.braking:
-                    max_speed = BRAKE_MAX_SPEED
-                else:
-                    max_speed = MAX_SPEED
-                body.velocity = max_speed * body.velocity.normalized()
-
+        apply_inputs((self,))
+        steer_bots((self,))
+        apply_forces((self,), dt)
+        return self.step(dt)
+
+    def step(self, dt):
+        """
+        Simulate the world for dt seconds. Forces should already have been applied with apply_forces.
+        :return: the frame count
+        """
+        start = time.perf_counter()
         self.space.step(dt)  # Simulate world
+        self.last_physics_time = time.perf_counter() - start
+        self.mean_physics_time += (self.last_physics_time - self.mean_physics_time) / 16
         self.frames += 1
+        self.elapsed += dt
+        if self.is_over():
+            log.info('%s finished after %s frames', self.id, self.frames)
+            self.finished = True
+        self.publish()
+        self.mean_step_time += (time.perf_counter() - start - self.mean_step_time) / 16
 
         return self.frames
 
+    def get_snapshot(self) -> Snapshot:
+        """
+        Capture the state of every player, reading the store's columns in team order.
+        """
+        store = self.store
+        now = self.elapsed
+        states = []
+        for slot in store.order:
+            body = store.bodies[slot]
+            x, y = body.position
+            boosting, boost_level = boost_state(store.began_boost[slot], now)
+            states.append(PlayerState(slot, store.ids[slot], store.teams[slot].id, bool(store.living[slot]), x, y,
+                                      body.angle, boosting, boost_level))
+        return Snapshot(self.frames, tuple(states), tuple(self.events), self.finished)
+
+    def teardown(self):
+        """
+        Free the physics objects of a game that is no longer being run. The game cannot be updated afterwards.
+        """
+        log.debug('%s tearing down', self.id)
+        self.space.remove(*self.space.shapes)
+        self.space.remove(*self.space.bodies)
+        for body in self.store.bodies:
+            body.player = None
+        self.trucks = []
+        self.spare_trucks = []
+        self.space = None
+
+    def publish(self):
+        """
+        Capture the current state and swap it in as the published snapshot. Rebinding an attribute is atomic, so readers
+        on other threads see either the old snapshot or the new one, never a half-updated game.
+        """
+        self.snapshot = self.get_snapshot()
+
     def get_encoded(self) -> dict:
-        return {
-            'frames': self.frames,
-            'teams': [t.get_encoded() for t in self.teams],
-            'events': self.events,
-        }
+        return self.snapshot.get_encoded()
 
     def get_player_by_id(self, player_id) -> (Player, None):
-        for p in self.players:
-            if p.id == player_id:
-                return p
-        return None
+        return self.player_with_id(player_id)
 
-    def create_team(self) -> Team:
-        t = Team(self, util.random_string(PLAYER_ID_LENGTH))
+    def create_team(self, team_id=None) -> Team:
+        if team_id is None:
+            team_id = util.random_string(PLAYER_ID_LENGTH)
+        t = Team(self, team_id)
         self.teams.append(t)
         return t
 
 
+class GamePool:
+    """
+    Idle GameInstances with their space, arena and handlers already built, to be set up as new games. Finished games
+    are reset and put back, so taking one costs no more than a new id and a few spare trucks.
+
+    take() and recycle() may be called from different threads. Deque appends and pops are atomic, and an instance is
+    only in the pool while no one else is using it.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: most idle instances to keep. Any more are torn down when recycled.
+        """
+        self.size = size
+        self.idle = deque()
+        self.created = 0
+        self.reused = 0
+
+    def __len__(self):
+        return len(self.idle)
+
+    def __repr__(self):
+        return 'GamePool(idle={}, created={}, reused={})'.format(len(self.idle), self.created, self.reused)
+
+    def prewarm(self, count, players=0):
+        """
+        Build instances until count are idle.
+        :param players: how many players each should have spare trucks for
+        """
+        while len(self.idle) < min(count, self.size):
+            inst = GameInstance(None)
+            inst.reserve(players)
+            self.created += 1
+            self.idle.append(inst)
+
+    def take(self, g_id, player_count=0) -> GameInstance:
+        """
+        :param player_count: how many players the game will have, so that their trucks are built now
+        :return: an idle instance, or a new one if there are none, with the given id
+        """
+        try:
+            inst = self.idle.pop()  # The most recently used, whose memory is likeliest to be warm
+            self.reused += 1
+        except IndexError:
+            inst = GameInstance(g_id)
+            self.created += 1
+        inst.id = g_id
+        inst.reserve(player_count)
+        return inst
+
+    def recycle(self, inst: GameInstance):
+        """
+        Reset a game that is no longer being run and keep it for later, or tear it down if the pool is full.
+        """
+        if len(self.idle) >= self.size:
+            inst.teardown()
+            return
+        inst.reset()
+        self.idle.append(inst)
+
+
+def apply_inputs(games):
+    """
+    Apply the newest input of every player of every running game, in one pass. However many inputs a client sent since
+    the last tick, this costs one check per player.
+    """
+    for inst in games:
+        if not inst.running:
+            continue
+        for p in inst.store.players:
+            sequence, rotation = p.input
+            if sequence != p.applied_input:
+                p.applied_input = sequence
+                p.body.angle = rotation
+
+
+def steer_bots(games):
+    """
+    Decide where every bot of every running game goes, in one pass. Each bot heads for the nearest living enemy, away
+    from walls it is about to hit, and boosts when it has a target in range. To spread the work out, a bot only thinks
+    every BOT_THINK_FRAMES frames, staggered by its slot.
+    """
+    atan2 = math.atan2
+    center_x, center_y = ARENA_WIDTH / 2, ARENA_HEIGHT / 2
+    boost_range = BOT_BOOST_RANGE ** 2
+
+    for inst in games:
+        if not inst.running or not inst.bots:
+            continue
+        now = inst.elapsed
+        store = inst.store
+        living, team_index, began_boost = store.living, store.team_index, store.began_boost
+        thinking = [b.slot for b in inst.bots if living[b.slot] and (inst.frames + b.slot) % BOT_THINK_FRAMES == 0]
+        if not thinking:
+            continue
+
+        # Read every living player's position once for all of this game's bots
+        targets = []
+        for slot, body in enumerate(store.bodies):
+            if living[slot]:
+                x, y = body.position
+                targets.append((team_index[slot], x, y))
+
+        for bot in thinking:
+            body = store.bodies[bot]
+            bot_team = team_index[bot]
+            bx, by = body.position
+            if not (BOT_WALL_MARGIN < bx < ARENA_WIDTH - BOT_WALL_MARGIN and
+                    BOT_WALL_MARGIN < by < ARENA_HEIGHT - BOT_WALL_MARGIN):
+                body.angle = atan2(center_y - by, center_x - bx)
+                continue
+
+            best = None
+            for team, x, y in targets:
+                if team == bot_team:
+                    continue
+                distance = (x - bx) * (x - bx) + (y - by) * (y - by)
+                if best is None or distance < best[0]:
+                    best = distance, x, y
+            if best is None:
+                continue
+
+            distance, x, y = best
+            body.angle = atan2(y - by, x - bx)
+            if distance < boost_range and began_boost[bot] + BOOST_DURATION + BOOST_COOLDOWN <= now:
+                began_boost[bot] = now
+
+
+def apply_forces(games, dt):
+    """
+    Push the living players along in their proper directions at their proper speeds, then apply friction and speed
+    limits, for every player of every running game in one pass. Math is done on plain floats and the store's columns, so
+    the only Vec2ds made per body are the ones pymunk builds when its velocity is read and written back, and no player
+    attributes are looked up.
+    """
+    cos, sin, hypot = math.cos, math.sin, math.hypot
+    friction = FRICTION * dt
+
+    for inst in games:
+        if not inst.running:
+            continue
+        now = inst.elapsed
+        store = inst.store
+        living, began_boost, braking = store.living, store.began_boost, store.braking
+        for slot, body in enumerate(store.bodies):
+            vx, vy = body.velocity  # pymunk only exposes velocity as a Vec2d, so this and the write below make one each
+            boosting = began_boost[slot] + BOOST_DURATION > now
+            alive = living[slot]
+
+            if alive:
+                accel = (BOOST_FORCE if boosting else NORMAL_FORCE) / PLAYER_MASS
+                angle = body.angle
+                vx += accel * cos(angle)
+                vy += accel * sin(angle)
+                body.angular_velocity = 0
+
+            speed = hypot(vx, vy)
+            if speed > 0:  # Apply friction
+                if speed < MIN_SPEED:
+                    vx = vy = 0.0
+                else:
+                    vx -= vx / speed * friction
+                    vy -= vy / speed * friction
+                    speed = hypot(vx, vy)
+            if speed > MAX_SPEED:
+                if not alive:
+                    max_speed = DEAD_MAX_SPEED
+                elif boosting:
+                    max_speed = BOOST_MAX_SPEED
+                elif braking[slot]:
+                    max_speed = BRAKE_MAX_SPEED
+                else:
+                    max_speed = MAX_SPEED
+                vx *= max_speed / speed
+                vy *= max_speed / speed
+
+            body.velocity = vx, vy
+
+
 if __name__ == '__main__':
     from pprint import pprint
     game = GameInstance('testid')
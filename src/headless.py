@@ -0,0 +1,139 @@
+"""
+Headless simulation. Plays bot-only matches with ticks run back to back instead of at wall-clock pace, optionally
+across a pool of worker processes, for tuning game constants, training bots and benchmarking. Run it from this
+directory, like main.py:
+
+    python headless.py --teams 2 --players 3 --matches 200 --workers 4 --set BOOST_FORCE=60
+
+Games only ever read their own simulated clock, so a match plays out the same however fast it is run. Each match is
+seeded, so a seed reproduces a match with the same constants.
+"""
+import argparse
+import ast
+import collections
+import functools
+import json
+import logging
+import multiprocessing
+import random
+import statistics
+import sys
+import time
+
+import constants
+import game
+
+log = logging.getLogger('headless')
+
+
+def override_constants(overrides):
+    """
+    Change game constants in this process. The engine imported them by name, so it is updated along with
+    game.constants.
+    :param overrides: constant name -> value
+    """
+    engine = sys.modules['game.game']
+    for name, value in overrides.items():
+        if not hasattr(game.constants, name):
+            raise KeyError('no game constant named {}'.format(name))
+        setattr(game.constants, name, value)
+        setattr(engine, name, value)
+
+
+def run_match(seed, team_count, players_per_team, dt=constants.GAME_UPDATE_PERIOD):
+    """
+    Play one bot-only match to the end as fast as possible.
+    :return: a dict describing how it went
+    """
+    random.seed(seed)
+    inst = game.GameInstance('headless-{}'.format(seed))
+    for _ in range(team_count):
+        team = inst.create_team()
+        for _ in range(players_per_team):
+            team.create_player(bot=True)
+    inst.init()
+
+    start = time.perf_counter()
+    while not inst.finished:
+        inst.update(dt)
+    wall = time.perf_counter() - start
+
+    survivors = [sum(1 for p in t if p.living) for t in inst.teams]
+    living_teams = [i for i, count in enumerate(survivors) if count]
+    inst.teardown()
+    return {
+        'seed': seed,
+        'frames': inst.frames,
+        'simulated': inst.elapsed,
+        'wall': wall,
+        'speedup': inst.elapsed / wall if wall else None,
+        'survivors': survivors,
+        'winner': living_teams[0] if len(living_teams) == 1 else None,  # A team index, None for a draw
+    }
+
+
+def run_matches(seeds, team_count, players_per_team, workers=1, overrides=None, dt=constants.GAME_UPDATE_PERIOD):
+    """
+    Play a match for each seed, in this process or across a pool of workers.
+    :return: the results of run_match, in no particular order
+    """
+    overrides = overrides or {}
+    play = functools.partial(run_match, team_count=team_count, players_per_team=players_per_team, dt=dt)
+    if workers <= 1:
+        override_constants(overrides)
+        return [play(seed) for seed in seeds]
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=override_constants, initargs=(overrides,)) as pool:
+        return list(pool.imap_unordered(play, seeds))
+
+
+def summarize(results, wall):
+    wins = collections.Counter(r['winner'] for r in results)
+    simulated = sum(r['simulated'] for r in results)
+    return {
+        'matches': len(results),
+        'wall': wall,
+        'simulated': simulated,
+        'speedup': simulated / wall if wall else None,
+        'frames_per_second': sum(r['frames'] for r in results) / wall if wall else None,
+        'match_length_median': statistics.median(r['simulated'] for r in results) if results else None,
+        'wins': {str(team): wins[team] for team in sorted(t for t in wins if t is not None)},
+        'draws': wins[None],
+    }
+
+
+def parse_override(text):
+    name, _, value = text.partition('=')
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        raise argparse.ArgumentTypeError('expected NAME=VALUE with a Python literal value, got {}'.format(text))
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--teams', type=int, default=2)
+    parser.add_argument('--players', type=int, default=1, help='players per team')
+    parser.add_argument('--matches', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first match, the rest count up from it')
+    parser.add_argument('--workers', type=int, default=1, help='processes to play matches in')
+    parser.add_argument('--dt', type=float, default=constants.GAME_UPDATE_PERIOD, help='simulated seconds per tick')
+    parser.add_argument('--set', dest='overrides', type=parse_override, action='append', default=[],
+                        metavar='NAME=VALUE', help='override a constant from game/constants.py')
+    parser.add_argument('--results', action='store_true', help='include every match in the output')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    start = time.perf_counter()
+    results = run_matches(range(args.seed, args.seed + args.matches), args.teams, args.players, args.workers,
+                          dict(args.overrides), args.dt)
+    summary = summarize(results, time.perf_counter() - start)
+    if args.results:
+        summary['results'] = sorted(results, key=lambda r: r['seed'])
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,261 @@
+"""
+Load generator. Spawns simulated clients that go through matchmaking, join their game and stream movement input the way
+the browser does, then reports how the server held up.
+
+Run it from this directory, like main.py:
+
+    python loadtest.py --clients 40 --gamemode ffa3 --duration 30
+
+Without --url, a server is started in this process on its own thread. The clients share a core with it, so point --url
+at a separately started server for capacity numbers. Either way, server statistics are read from its /metrics endpoint
+once the clients are done. With --nodes, the in-process server is a router in front of that many node processes, and
+server statistics are not collected.
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import random
+import statistics
+import struct
+import threading
+import time
+
+import tornado.ioloop
+from tornado import gen, httpclient, websocket
+
+import constants
+import main
+import protocol
+import router
+import tokens
+
+log = logging.getLogger('loadtest')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)]
+
+
+class BotClient:
+    """
+    A single simulated player.
+    """
+
+    def __init__(self, base_url, gamemode, wire_format, delta):
+        self.base_url = base_url
+        self.gamemode = gamemode
+        self.wire_format = wire_format
+        self.delta = delta
+
+        self.match_time = None  # Seconds from joining the queue to getting a token
+        self.frame_times = []
+        self.bytes_received = 0
+        self.last_frame = None
+        self.error = None
+
+        self._direction = random.uniform(0, 2 * math.pi)
+
+    async def run(self, deadline):
+        try:
+            token = await self.find_match()
+            await self.play(token, deadline)
+        except Exception as e:
+            log.warning('client failed: %r', e)
+            self.error = e
+
+    async def find_match(self):
+        conn = await websocket.websocket_connect(self.base_url + '/socket/matchmaking')
+        start = time.monotonic()
+        conn.write_message(self.gamemode)
+        await conn.read_message()  # Our lobby id
+        while True:
+            msg = await conn.read_message()
+            if msg is None:
+                raise ConnectionError('matchmaking socket closed')
+            data = json.loads(msg)
+            if data['enough']:
+                self.match_time = time.monotonic() - start
+                conn.close()
+                return data['token']
+
+    async def play(self, token, deadline):
+        game_id, player_id, node, expires = tokens.decode(token)
+        base_url = node.replace('http', 'ws', 1) if node else self.base_url  # The node that runs our game
+        conn = await websocket.websocket_connect(base_url + '/socket/game')
+        conn.write_message(json.dumps({'token': token, 'format': self.wire_format, 'delta': self.delta}))
+        handshake = json.loads(await conn.read_message())
+        if not handshake.get('valid'):
+            raise ConnectionError('token rejected')
+
+        sender = tornado.ioloop.PeriodicCallback(lambda: self.send_input(conn), constants.CLIENT_INPUT_PERIOD)
+        sender.start()
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    msg = await gen.with_timeout(datetime.timedelta(seconds=deadline - time.monotonic()),
+                                                 conn.read_message())
+                except gen.TimeoutError:
+                    break
+                if msg is None:
+                    break  # The game ended
+                self.on_frame(msg)
+        finally:
+            sender.stop()
+            conn.close()
+
+    def on_frame(self, msg):
+        self.frame_times.append(time.monotonic())
+        if isinstance(msg, bytes):
+            self.bytes_received += len(msg)
+            self.last_frame, = struct.unpack_from('<I', msg, 1)
+        else:
+            self.bytes_received += len(msg.encode('utf-8'))
+            self.last_frame = json.loads(msg)['frames']
+
+    def send_input(self, conn):
+        self._direction += random.uniform(-0.5, 0.5)
+        conn.write_message(json.dumps({
+            'movement': {'x': math.cos(self._direction), 'y': math.sin(self._direction)},
+            'ack': self.last_frame,
+            'events': [],
+        }))
+
+    @property
+    def frame_intervals(self):
+        return [b - a for a, b in zip(self.frame_times, self.frame_times[1:])]
+
+    @property
+    def bytes_per_second(self):
+        if len(self.frame_times) < 2:
+            return None
+        return self.bytes_received / (self.frame_times[-1] - self.frame_times[0])
+
+
+def start_local_server(port, nodes=0):
+    """
+    Start a server on its own thread and IOLoop.
+    :param nodes: if not 0, start a router in front of this many node processes instead
+    """
+    started = threading.Event()
+
+    def serve():
+        loop = tornado.ioloop.IOLoop()
+        loop.make_current()
+        if nodes:
+            manager = router.Router(main.GAMEMODES, router.spawn_nodes(nodes, port + 1))
+            manager.init()
+            router.get_app(manager).listen(port)
+        else:
+            manager = main.GameManager(main.GAMEMODES)
+            manager.init()
+            main.get_app(manager).listen(port)
+        started.set()
+        loop.start()
+
+    threading.Thread(target=serve, name='loadtest-server', daemon=True).start()
+    started.wait()
+
+
+async def fetch_server_metrics(base_url):
+    """
+    :return: the server's metrics as JSON, or None if they could not be read
+    """
+    url = base_url.replace('ws', 'http', 1) + '/metrics?format=json'
+    try:
+        response = await httpclient.AsyncHTTPClient().fetch(url)
+    except Exception as e:
+        log.warning('could not read server metrics from %s: %r', url, e)
+        return None
+    return json.loads(response.body.decode('utf-8'))
+
+
+def summarize(clients, server_metrics, elapsed):
+    period = constants.GAME_TRANSMISSION_PERIOD / 1000
+    match_times = [c.match_time for c in clients if c.match_time is not None]
+    intervals = [i for c in clients for i in c.frame_intervals]
+    rates = [c.bytes_per_second for c in clients if c.bytes_per_second is not None]
+
+    summary = {
+        'clients': len(clients),
+        'errors': sum(1 for c in clients if c.error is not None),
+        'matched': len(match_times),
+        'elapsed': elapsed,
+        'time_to_match_median': statistics.median(match_times) if match_times else None,
+        'time_to_match_p99': percentile(match_times, 99),
+        'frames': len(intervals),
+        'frame_interval_median': statistics.median(intervals) if intervals else None,
+        'frame_interval_p99': percentile(intervals, 99),
+        'frame_jitter_mean': statistics.mean(abs(i - period) for i in intervals) if intervals else None,
+        'bytes_per_second_per_client': statistics.mean(rates) if rates else None,
+    }
+    if server_metrics is not None:
+        clusters = server_metrics['clusters']
+        summary['server_ticks'] = sum(c['ticks'] for c in clusters)
+        summary['server_tick_overruns'] = sum(c['overruns'] for c in clusters)
+        summary['server_dropped_ticks'] = sum(c['dropped_ticks'] for c in clusters)
+        summary['server_max_jitter'] = max((c['max_jitter'] for c in clusters), default=None)
+        summary['server_encode_p99'] = server_metrics['broadcast']['encode_times']['p99']
+        summary['server_send_p99'] = server_metrics['broadcast']['send_times']['p99']
+    return summary
+
+
+async def run_clients(args, base_url):
+    codes = [gm.code for gm in main.GAMEMODES]
+    deadline = time.monotonic() + args.ramp + args.duration
+    clients = []
+    tasks = []
+    for i in range(args.clients):
+        gamemode = random.choice(codes) if args.gamemode == 'random' else args.gamemode
+        client = BotClient(base_url, gamemode, args.format, args.delta)
+        clients.append(client)
+        tasks.append(gen.convert_yielded(client.run(deadline)))  # Starts the client now
+        if args.ramp:
+            await gen.sleep(args.ramp / args.clients)
+    await gen.multi(tasks)
+    return clients, None if args.nodes else await fetch_server_metrics(base_url)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server to test, e.g. ws://localhost:8080 (default: start one in-process)')
+    parser.add_argument('--port', type=int, default=8090, help='port for the in-process server')
+    parser.add_argument('--nodes', type=int, default=0,
+                        help='run the in-process server as a router for this many nodes on the next ports')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--gamemode', default='duel',
+                        help='a gamemode code, several separated by commas to queue for all of them, or "random"')
+    parser.add_argument('--format', default=protocol.JSON, choices=protocol.FORMATS)
+    parser.add_argument('--delta', action='store_true', help='ask for delta frames')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to play after the last client joins')
+    parser.add_argument('--ramp', type=float, default=2, help='seconds over which clients join')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+    codes = [gm.code for gm in main.GAMEMODES]
+    if args.gamemode != 'random' and not all(code in codes for code in args.gamemode.split(',')):
+        parser.error('unknown gamemode {}, choose from {}'.format(args.gamemode, ', '.join(codes)))
+
+    logging.basicConfig(level=logging.WARNING)
+
+    base_url = args.url
+    if base_url is None:
+        start_local_server(args.port, args.nodes)
+        base_url = 'ws://localhost:{}'.format(args.port)
+
+    start = time.monotonic()
+    clients, server_metrics = tornado.ioloop.IOLoop.current().run_sync(lambda: run_clients(args, base_url))
+    summary = summarize(clients, server_metrics, time.monotonic() - start)
+
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print('{:32} {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    run()
@@ -3,14 +3,18 @@ Main server file. The server is run with this.
 """
 import logging
 import os
+import time
 
 import tornado.ioloop
 import tornado.web
 
+import broadcast
 import constants
 import matchmaking
+import remote
 import sockets
 import threadmanager
+import tokens
 import views
 
 PATH = os.getcwd()
@@ -23,29 +27,106 @@ GAMEMODES = [
     matchmaking.Gamemode('5v5 TDM', 'tdm5', 2, 5),
 ]
 
+CLUSTER_BACKENDS = {
+    'thread': threadmanager.RoomCluster,
+    'process': remote.ProcessRoomCluster,
+}
+
 log = logging.getLogger(__name__)
 
 
 class GameManager:
 
     def __init__(self, gamemodes,
-                 threads_update_period=constants.ID_LENGTH, matchmaking_update_period=constants.MM_UPDATE_PERIOD):
+                 threads_update_period=constants.ID_LENGTH, transmission_period=constants.GAME_TRANSMISSION_PERIOD):
         self.gamemodes = gamemodes
+        self.transmission_period = transmission_period
+
+        self.thread_man = threadmanager.ThreadsManager(5, 10, threads_update_period,
+                                                       CLUSTER_BACKENDS[constants.CLUSTER_BACKEND])
+        self.mmers = [matchmaking.Matchmaker(gm, self) for gm in gamemodes]
 
-        self.thread_man = threadmanager.ThreadsManager(5, 10, threads_update_period)
-        self.mmers = [matchmaking.Matchmaker(gm, matchmaking_update_period, self) for gm in gamemodes]
+        self.broadcasters = {}
+        self.initializers = {}  # game id -> GameInitializationManager
+        self.started = time.monotonic()
 
-        self.tokens = {}
+        self._rebalancer = tornado.ioloop.PeriodicCallback(self.thread_man.rebalance, constants.REBALANCE_PERIOD)
+        self._reaper = tornado.ioloop.PeriodicCallback(self.reap_games, constants.REAP_PERIOD)
 
     def init(self):
         for mm in self.mmers:
             mm.init()
-
-
-def get_app():
-
-    manager = GameManager(GAMEMODES)
-    manager.init()
+        self._rebalancer.start()
+        self._reaper.start()
+
+    def gamemode_with_code(self, code) -> matchmaking.Gamemode:
+        for gm in self.gamemodes:
+            if gm.code == code:
+                return gm
+        raise KeyError(code)
+
+    def create_game(self, gamemode, humans):
+        """
+        Create a game along with its broadcaster and initializer, and fill it with players. Raises an OutOfSpaceError if
+        there is no space for it.
+        :param humans: how many of its players are people, the rest are bots
+        :return: (game id, the game players of the humans)
+        """
+        game_id, room_cluster = self.thread_man.create_game(gamemode.total_players)
+        inst = self.thread_man.get_game(game_id)
+        self.broadcasters[game_id] = broadcast.GameBroadcaster(inst, self.transmission_period)
+        players = gamemode.fill_game(humans, inst)
+        initializer = self.initializers[game_id] = matchmaking.GameInitializationManager(inst)
+        initializer.begin()
+        return game_id, players
+
+    def issue_token(self, game_id, player_id) -> str:
+        """
+        Create the token a lobby player uses to join their game. Tokens are signed rather than stored.
+        """
+        return tokens.issue(game_id, player_id)
+
+    def reap_games(self):
+        """
+        Tear down games that are over, that everyone has left, or that never got all of their players, so that their
+        slots are recycled. Tokens for a reaped game stop working, as it is no longer in the registry.
+        """
+        now = time.monotonic()
+        reaped = False
+        for game_id, inst in list(self.thread_man.game_registry.items()):
+            broadcaster = self.broadcasters.get(game_id)
+            if inst.snapshot.finished:
+                reason = 'Game over'
+            elif broadcaster is not None and broadcaster.abandoned:
+                reason = 'Abandoned'
+            elif not inst.initialized and broadcaster is not None and \
+                    now - broadcaster.created > constants.READY_TIMEOUT:
+                reason = 'Not everyone joined'
+            else:
+                continue
+
+            if self.thread_man.is_migrating(game_id):
+                continue  # Try again next time
+
+            # Send the final state before the game is removed, as its cluster resets it for reuse
+            if broadcaster is not None:
+                broadcaster.close(reason)
+                del self.broadcasters[game_id]
+            self.initializers.pop(game_id, None)
+            self.thread_man.remove_game(game_id)
+            log.info('reaped game %s: %s', game_id, reason)
+            reaped = True
+
+        if reaped:
+            for mm in self.mmers:
+                mm.attempt_fill_game()  # Players may have been waiting for space
+
+
+def get_app(manager=None):
+
+    if manager is None:
+        manager = GameManager(GAMEMODES)
+        manager.init()
 
     return tornado.web.Application([
 
@@ -55,7 +136,11 @@ def get_app():
         (r'/game', views.GameView, {'manager': manager}),
 
         (r'/socket/matchmaking', sockets.LobbyPlayerConnection, {'manager': manager}),
-        (r'/socket/game', sockets.GamePlayerConnection, {'manager': manager, 'transmission_pd': constants.GAME_TRANSMISSION_PERIOD}),
+        (r'/socket/game', sockets.GamePlayerConnection, {'manager': manager}),
+
+        (r'/metrics', views.MetricsView, {'manager': manager}),
+        (r'/admin/profile', views.ProfileView, {'manager': manager}),
+        (r'/internal/games', views.CreateGameView, {'manager': manager}),
 
     ], template_path='../views')
 
@@ -1,13 +1,17 @@
 """
 The code that manages matchmaking and custom games.
 """
+import collections
+import json
 import logging
-import queue
+import time
 
 import tornado.ioloop
+from tornado import websocket
 
 import constants
 import game
+import metrics
 import threadmanager
 import util
 
@@ -15,11 +19,92 @@ log = logging.getLogger('matchmaking')
 
 
 class LobbyPlayer:
+    """
+    A player waiting for a game. They may be queued for several gamemodes at once, and are taken out of every queue
+    as soon as one of them places them.
+    """
 
-    def __init__(self, socket, gamemode, id_len):
+    def __init__(self, socket, id_len):
         self.socket = socket
         self.id = util.random_string(id_len)
-        self.gamemode: Gamemode = gamemode
+        self.gamemode: Gamemode = None  # The one we got placed in
+        self.matchmakers = []  # The ones we are queued in
+        self.claimed = False  # Whether a matchmaker took us for a game, which may still be being created
+        self.joined = time.monotonic()
+
+    def claim(self, matchmaker):
+        """
+        Called when a matchmaker takes us for a game. Leaves every other queue, and stays out of the ones joined later.
+        """
+        self.gamemode = matchmaker.gamemode
+        self.claimed = True
+        for mm in self.matchmakers:
+            if mm is not matchmaker:
+                mm.remove_player(self)
+
+    def release(self, matchmaker):
+        """
+        Called when the game a matchmaker took us for could not be created. Rejoins the front of every other queue we
+        asked for; the matchmaker puts us back in its own.
+        """
+        self.gamemode = None
+        self.claimed = False
+        for mm in self.matchmakers:
+            if mm is not matchmaker:
+                mm.players.put_back([self])
+
+
+class PlayerQueue:
+    """
+    Lobby players in the order they joined, indexed by id so that anyone can be taken out in O(1) when they leave. It
+    is only used from the IOLoop, so it takes no locks.
+    """
+
+    def __init__(self):
+        self._players = collections.OrderedDict()  # id -> LobbyPlayer, oldest first
+
+    def __len__(self):
+        return len(self._players)
+
+    def __iter__(self):
+        return iter(self._players.values())
+
+    def __contains__(self, player):
+        return player.id in self._players
+
+    def put(self, player):
+        self._players[player.id] = player
+
+    def remove(self, player):
+        """
+        :return: whether the player was queued
+        """
+        return self._players.pop(player.id, None) is not None
+
+    def put_back(self, players):
+        """
+        Queue players that were taken again, ahead of everyone else and in the order given.
+        """
+        for player in reversed(players):
+            self._players[player.id] = player
+            self._players.move_to_end(player.id, last=False)
+
+    def take(self, count):
+        """
+        Dequeue the count oldest players, or nobody if there are fewer than that.
+        :return: the players, oldest first, or None
+        """
+        if len(self._players) < count:
+            return None
+        return [self._players.popitem(last=False)[1] for _ in range(count)]
+
+    def oldest_wait(self, now=None):
+        """
+        :return: how many seconds the oldest player has been waiting, or None if nobody is
+        """
+        for player in self._players.values():
+            return (time.monotonic() if now is None else now) - player.joined
+        return None
 
 
 class Gamemode:
@@ -40,76 +125,212 @@ class Gamemode:
     def total_players(self):
         return self.team_count * self.players_per_team
 
-    def fill_game(self, players, inst: game.GameInstance):
+    def fill_game(self, humans, inst: game.GameInstance):
+        """
+        Create the teams of a game, with a game player for each human and bots in the slots left over.
+        :param humans: how many of the total_players are people
+        :return: the game players of the humans
+        """
         out = []
         for t in range(self.team_count):
             team = inst.create_team()
             for p in range(self.players_per_team):
-                lobby_player = players.get()
-                game_player = team.create_player()
-                out.append((lobby_player, game_player))
+                bot = t * self.players_per_team + p >= humans
+                game_player = team.create_player(bot=bot)
+                if not bot:
+                    out.append(game_player)
         return out
 
 
 class Matchmaker:
     """
-    Handles the matchmaking for a single gamemode
+    Handles the matchmaking for a single gamemode. Games are filled as soon as enough players are queued, and again
+    whenever the manager frees up space for games.
     """
 
-    def __init__(self, gamemode: Gamemode, update_period: float, manager):
-        self.update_period = update_period
+    def __init__(self, gamemode: Gamemode, manager):
         self.gamemode = gamemode
         self.manager = manager
 
         self.next_id = 0
-        self.players = queue.Queue()
-        self._periodic_callback = tornado.ioloop.PeriodicCallback(self.attempt_fill_game, self.update_period)
+        self.players = PlayerQueue()
+        self.games_created = 0
+        self.wait_times = metrics.Histogram(metrics.WAIT_BUCKETS)  # Seconds from joining the queue to being placed
+
+        self.subscribers = set()  # Lobby sockets that want queue status updates
+        self._status_pending = False
+        self._backfill_timeout = None
 
     def __repr__(self):
         return 'Matchmaker({})'.format(self.gamemode)
 
     def player_count(self):
-        return self.players.qsize()
+        return len(self.players)
 
     def init(self):
         log.debug('initializing %s', self)
-        self._periodic_callback.start()
+        self.attempt_fill_game()
 
     def add_player(self, player):
+        player.matchmakers.append(self)
+        if player.claimed:
+            return  # Another queue is creating a game for them, and they are queued here if that fails
         self.players.put(player)
+        if not self.attempt_fill_game():
+            self.notify_player_count()
+
+    def remove_player(self, player):
+        """
+        Take a player who left out of the queue.
+        """
+        if self.players.remove(player):
+            log.debug('%s removed %s from the queue', self, player.id)
+            self.notify_player_count()
+
+    def subscribe(self, socket):
+        self.subscribers.add(socket)
+
+    def unsubscribe(self, socket):
+        self.subscribers.discard(socket)
+
+    def notify_player_count(self):
+        """
+        Schedule a queue status update for the subscribers. Called whenever the count changes. Changes that come in
+        before the update is sent are coalesced into it.
+        """
+        if not self._status_pending:
+            self._status_pending = True
+            tornado.ioloop.IOLoop.current().call_later(constants.QUEUE_STATUS_DELAY, self.send_player_count)
+
+    def send_player_count(self):
+        """
+        Encode the queue status once and send it to every subscriber.
+        """
+        self._status_pending = False
+        if not self.subscribers:
+            return
+        message = json.dumps({'count': self.player_count(), 'enough': False, 'gamemode': self.gamemode.code})
+        for socket in list(self.subscribers):
+            try:
+                socket.write_message(message)
+            except websocket.WebSocketClosedError:
+                self.subscribers.discard(socket)
 
     def attempt_fill_game(self):
-        player_count = self.players.qsize()
-        if player_count >= self.gamemode.total_players:
-            log.info('%s has enough players (%s/%s) for a new game', self, player_count, self.gamemode.total_players)
+        """
+        Create games for as many queued players as we can, backfilling with bots for anyone who has waited longer than
+        BOT_BACKFILL_DELAY.
+        :return: whether any game was created
+        """
+        created = False
+        while self.fill_game():
+            created = True
+        while self.backfill_due() and self.fill_game(backfill=True):
+            created = True
+        if created:
+            self.notify_player_count()
+        self.schedule_backfill()
+        return created
+
+    def backfill_due(self):
+        waited = self.players.oldest_wait()
+        return constants.BOT_BACKFILL_DELAY is not None and waited is not None and \
+            waited >= constants.BOT_BACKFILL_DELAY
+
+    def schedule_backfill(self):
+        """
+        Make sure we try again when the oldest queued player is due for backfill. Players that are overdue are waiting
+        for space, and are retried when the manager frees some.
+        """
+        if self._backfill_timeout is not None or constants.BOT_BACKFILL_DELAY is None:
+            return
+        waited = self.players.oldest_wait()
+        if waited is None or waited >= constants.BOT_BACKFILL_DELAY:
+            return
+        self._backfill_timeout = tornado.ioloop.IOLoop.current().call_later(constants.BOT_BACKFILL_DELAY - waited,
+                                                                            self.on_backfill_due)
+
+    def on_backfill_due(self):
+        self._backfill_timeout = None
+        self.attempt_fill_game()
+
+    def humans_for_game(self, backfill=False):
+        """
+        :param backfill: make up for missing players with bots, as long as there is at least one player
+        :return: how many queued players the next game would take, or 0 if there are not enough
+        """
+        player_count = len(self.players)
+        total_players = self.gamemode.total_players
+        humans = min(player_count, total_players) if backfill else total_players
+        if humans and player_count >= humans:
+            log.info('%s has enough players (%s/%s) for a new game%s', self, player_count, total_players,
+                     ' with {} bots'.format(total_players - humans) if humans < total_players else '')
+            return humans
+        return 0
+
+    def take_players(self, count):
+        """
+        Dequeue the players of a new game and take them out of the other queues they are in.
+        """
+        lobby_players = self.players.take(count)
+        for lob in lobby_players:
+            lob.claim(self)
+        return lobby_players
+
+    def place(self, lobby_players, tokens):
+        """
+        Send each placed player the token to join their game with.
+        """
+        self.games_created += 1
+        now = time.monotonic()
+        for lob, token in zip(lobby_players, tokens):
+            self.wait_times.observe(now - lob.joined)
             try:
-                game_id, room_cluster = self.manager.thread_man.create_game()
-                inst = self.manager.thread_man.get_game(game_id)
-                log.debug('created game with id %s', game_id)
-                filled_players = self.gamemode.fill_game(self.players, inst)
-                for lob, player in filled_players:
-                    token = util.random_string(constants.ID_LENGTH)
-                    self.manager.tokens[token] = game_id, player.id
-                    lob.socket.on_enough_players(token)
-                GameInitializationManager(inst).begin()
+                lob.socket.on_enough_players(token)
+            except websocket.WebSocketClosedError:
+                log.debug('%s left before they were placed', lob.id)  # Their slot is reaped with the game
 
-            except threadmanager.OutOfSpaceError:
-                log.info('%s could not create game because there are not enough slots.', self)
+    def fill_game(self, backfill=False):
+        """
+        Create one game, if enough players are queued and there is space for it.
+        :param backfill: make up for missing players with bots, as long as there is at least one player
+        :return: whether a game was created
+        """
+        humans = self.humans_for_game(backfill)
+        if not humans:
+            return False
+        try:
+            game_id, game_players = self.manager.create_game(self.gamemode, humans)
+        except threadmanager.OutOfSpaceError:
+            log.info('%s could not create game because there are not enough slots.', self)
+            return False
+        log.debug('created game with id %s', game_id)
+        lobby_players = self.take_players(humans)
+        self.place(lobby_players, [self.manager.issue_token(game_id, player.id) for player in game_players])
+        return True
 
 
 class GameInitializationManager:
+    """
+    Starts a game the moment the last of its players is ready. Games that never get everyone are left to the reaper.
+    """
 
     def __init__(self, inst):
         self.inst = inst
-        self.task = tornado.ioloop.PeriodicCallback(self.periodic, constants.MM_UPDATE_PERIOD)
+        self.began = None
 
     def begin(self):
-        self.task.start()
+        self.began = time.monotonic()
 
-    def periodic(self):
+    def on_player_ready(self, player):
+        """
+        Called when a player's connection to the game is open.
+        """
+        player.ready = True
+        if self.inst.initialized:
+            return
         if self.inst.players_ready():
-            log.debug('initializing %s', self.inst)
-            self.inst.init()  # Initialize the game if everyone is ready
-            self.task.stop()
+            log.debug('initializing %s after %.3fs', self.inst, time.monotonic() - self.began)
+            self.inst.init()
         else:
             log.debug('not everyone is ready yet')
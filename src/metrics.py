@@ -0,0 +1,186 @@
+"""
+Runtime instrumentation. Hot paths record timings into Histograms, which cost a bisect and a few additions per
+observation, and collect() gathers them along with the scheduling statistics of every cluster when the metrics
+endpoint is read.
+
+Each histogram is only written by one thread. Readers on other threads may see an observation half-recorded, which is
+fine for monitoring.
+"""
+import bisect
+import time
+
+# Bucket upper bounds in seconds, roughly doubling from 10us to 1.3s
+TIME_BUCKETS = tuple(1e-5 * 2 ** i for i in range(18))
+
+# Bucket upper bounds in seconds for waiting in a matchmaking queue, from 100ms to about 7 minutes
+WAIT_BUCKETS = tuple(0.1 * 2 ** i for i in range(13))
+
+PREFIX = 'snowplows_'
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets.
+    """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        """
+        :param buckets: ascending upper bounds. Anything larger goes into an overflow bucket.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return 'Histogram(count={}, mean={})'.format(self.count, self.mean)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+        :param q: between 0 and 1
+        :return: the bound, the largest observation if it is in the overflow bucket, or None if nothing was observed
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return self.max
+
+    def get_encoded(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),  # One more than buckets, the last is the overflow
+        }
+
+
+def collect(manager) -> dict:
+    """
+    Gather every metric of a GameManager. Must be called on its IOLoop.
+    """
+    import broadcast  # Imported here, as broadcast uses this module too
+
+    thread_man = manager.thread_man
+    used = sum(len(t.games) for t in thread_man.threads)
+    opened = len(thread_man.threads) * thread_man.games_per_thread
+    capacity = thread_man.thread_limit * thread_man.games_per_thread
+
+    return {
+        'uptime': time.monotonic() - manager.started,
+        'clusters': [dict(cluster.get_metrics(), index=i) for i, cluster in enumerate(thread_man.threads)],
+        'slots': {
+            'used': used,
+            'open': opened,  # Slots in clusters that have been started
+            'capacity': capacity,  # Slots if every allowed cluster were started
+            'utilization': used / capacity if capacity else None,
+        },
+        'matchmaking': [
+            {
+                'gamemode': mm.gamemode.code,
+                'queue_depth': mm.player_count(),
+                'oldest_wait': mm.players.oldest_wait(),
+                'games_created': mm.games_created,
+                'wait_times': mm.wait_times.get_encoded(),
+            } for mm in manager.mmers
+        ],
+        'broadcast': {
+            'games': len(manager.broadcasters),
+            'sockets': sum(len(b.sockets) for b in manager.broadcasters.values()),
+            'pending_bytes': sum(s.pending_bytes for b in manager.broadcasters.values() for s in b.sockets),
+            'dropped_frames': sum(s.dropped_frames for b in manager.broadcasters.values() for s in b.sockets),
+            'encode_times': broadcast.encode_times.get_encoded(),
+            'send_times': broadcast.send_times.get_encoded(),
+        },
+    }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def _sample(lines, name, labels, value):
+    lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(labels), _format_value(value)))
+
+
+def _histogram(lines, name, labels, hist):
+    cumulative = 0
+    for bound, count in zip(hist['buckets'] + ['+Inf'], hist['counts']):
+        cumulative += count
+        _sample(lines, name + '_bucket', dict(labels, le=bound if bound == '+Inf' else '{:g}'.format(bound)),
+                cumulative)
+    _sample(lines, name + '_sum', labels, hist['sum'])
+    _sample(lines, name + '_count', labels, hist['count'])
+
+
+def render_text(data) -> str:
+    """
+    Format the output of collect() in the Prometheus text exposition format.
+    """
+    lines = []
+    _sample(lines, 'uptime_seconds', {}, data['uptime'])
+
+    for cluster in data['clusters']:
+        labels = {'cluster': cluster['index']}
+        for key in ('ticks', 'overruns', 'dropped_ticks'):
+            _sample(lines, 'cluster_{}_total'.format(key), labels, cluster[key])
+        for key in ('games', 'bodies', 'pooled_games', 'last_tick_time', 'mean_tick_time', 'mean_physics_time',
+                    'mean_jitter', 'max_jitter'):
+            _sample(lines, 'cluster_' + key, labels, cluster[key])
+        for key in ('tick_times', 'physics_times', 'python_times'):
+            if key in cluster:
+                _histogram(lines, 'cluster_' + key.replace('_times', '_seconds'), labels, cluster[key])
+        for g in cluster['game_stats']:
+            game_labels = dict(labels, game=g['id'])
+            for key in ('frames', 'players', 'mean_step_time', 'mean_physics_time'):
+                if key in g:
+                    _sample(lines, 'game_' + key, game_labels, g[key])
+
+    for key, value in data['slots'].items():
+        _sample(lines, 'slots_' + key, {}, value)
+
+    for mm in data['matchmaking']:
+        labels = {'gamemode': mm['gamemode']}
+        _sample(lines, 'matchmaking_queue_depth', labels, mm['queue_depth'])
+        _sample(lines, 'matchmaking_oldest_wait_seconds', labels, mm['oldest_wait'])
+        _sample(lines, 'matchmaking_games_created_total', labels, mm['games_created'])
+        _histogram(lines, 'matchmaking_wait_seconds', labels, mm['wait_times'])
+
+    _sample(lines, 'broadcast_games', {}, data['broadcast']['games'])
+    _sample(lines, 'broadcast_sockets', {}, data['broadcast']['sockets'])
+    _sample(lines, 'broadcast_pending_bytes', {}, data['broadcast']['pending_bytes'])
+    _sample(lines, 'broadcast_dropped_frames', {}, data['broadcast']['dropped_frames'])
+    _histogram(lines, 'broadcast_encode_seconds', {}, data['broadcast']['encode_times'])
+    _histogram(lines, 'broadcast_send_seconds', {}, data['broadcast']['send_times'])
+
+    return '\n'.join(lines) + '\n'
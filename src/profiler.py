@@ -0,0 +1,92 @@
+"""
+A sampling profiler for live threads. A separate thread looks at the target's stack every so often with
+sys._current_frames(), so nothing is installed on the target itself, and nothing at all runs while no profile is being
+taken.
+
+Results are collapsed stacks, one "outer;inner;innermost count" line per distinct stack, which flamegraph.pl and
+speedscope read directly.
+"""
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+import tornado.concurrent
+import tornado.ioloop
+
+import constants
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()  # Only one profile at a time, so they cannot skew each other
+
+
+class ProfilerBusyError(Exception):
+    """
+    Thrown when a profile is requested while another one is being taken.
+    """
+    pass
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def sample_stacks(thread_ident, duration, interval):
+    """
+    Sample the stack of a thread. Blocks for `duration`.
+    :param thread_ident: the ident of the thread to profile
+    :param duration: seconds to sample for
+    :param interval: seconds between samples
+    :return: a Counter of stacks, each a tuple of frame names from outermost to innermost
+    """
+    stacks = collections.Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_ident)
+        if frame is None:
+            break  # The thread is gone
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        del frame
+        stacks[tuple(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def profile(thread_ident, duration, interval=constants.PROFILE_INTERVAL) -> tornado.concurrent.Future:
+    """
+    Sample a thread from a new thread, without blocking the IOLoop. Raises ProfilerBusyError if another profile is
+    being taken.
+    :return: a Future for the Counter of stacks, resolved on the current IOLoop
+    """
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusyError
+    loop = tornado.ioloop.IOLoop.current()
+    future = tornado.concurrent.Future()
+
+    def run():
+        try:
+            stacks = sample_stacks(thread_ident, duration, interval)
+        except Exception as e:
+            loop.add_callback(future.set_exception, e)
+        else:
+            loop.add_callback(future.set_result, stacks)
+        finally:
+            _lock.release()
+
+    log.info('profiling thread %s for %ss', thread_ident, duration)
+    threading.Thread(target=run, name='profiler', daemon=True).start()
+    return future
+
+
+def collapse(stacks) -> str:
+    """
+    Format stacks in the collapsed format that flame graph tools take.
+    """
+    return ''.join('{} {}\n'.format(';'.join(stack), count) for stack, count in stacks.most_common())
@@ -0,0 +1,134 @@
+"""
+Wire formats for the game state frames sent to clients. The format is picked by the client during the token handshake.
+
+JSON frames are the output of Snapshot.get_encoded(). Binary frames are little-endian and laid out as follows:
+
+    header: type (uint8), frame number (uint32), player count (uint8)
+    player: slot (uint8), flags (uint8), x (int16), y (int16), direction (uint16), boost level (uint8)
+
+Positions are fixed-point with POSITION_SCALE units per pixel, the direction maps [0, 2pi) onto the full uint16 range
+and the boost level maps [0, 1] onto the full uint8 range. The decoder lives in static/js/game.js.
+
+Clients that ask for delta frames acknowledge the frames they have applied. Once the server has an acknowledged
+baseline for a client, it sends only the players and fields that changed since that baseline:
+
+    JSON:   {"frames": n, "baseline": b, "players": [{"id": ..., <changed fields>}, ...]}
+    binary: header: type (uint8), frame number (uint32), baseline frame number (uint32), player count (uint8)
+            player: slot (uint8), field mask (uint8), then each field whose bit is set in the mask, in the order above
+"""
+import json
+import math
+import struct
+
+JSON = 'json'
+BINARY = 'binary'
+FORMATS = (JSON, BINARY)
+
+# Binary message types
+FULL_FRAME = 0
+DELTA_FRAME = 1
+
+# Player flags
+FLAG_LIVING = 1
+FLAG_BOOSTING = 2
+
+POSITION_SCALE = 4
+ANGLE_SCALE = 65536 / (2 * math.pi)
+BOOST_SCALE = 255
+
+FRAME_HEADER = struct.Struct('<BIB')
+FRAME_PLAYER = struct.Struct('<BBhhHB')
+DELTA_HEADER = struct.Struct('<BIIB')
+DELTA_PLAYER = struct.Struct('<BB')
+DELTA_FIELDS = [struct.Struct(f) for f in ('<B', '<h', '<h', '<H', '<B')]  # In the same order as FRAME_PLAYER
+
+# The PlayerState fields that can change between frames, and their JSON names
+JSON_FIELDS = [('living', 'living'), ('x', 'x'), ('y', 'y'), ('direction', 'direction'),
+               ('boosting', 'isBoosting'), ('boost_level', 'boostLevel')]
+
+
+def quantize_position(v: float) -> int:
+    return max(-32768, min(32767, int(round(v * POSITION_SCALE))))
+
+
+def quantize_angle(a: float) -> int:
+    return int(round((a % (2 * math.pi)) * ANGLE_SCALE)) & 0xFFFF
+
+
+def quantize_boost(level: float) -> int:
+    return int(round(max(0.0, min(1.0, level)) * BOOST_SCALE))
+
+
+def quantize(state) -> tuple:
+    """
+    Turn a PlayerState into the fields of a binary player record, minus the slot.
+    """
+    flags = (FLAG_LIVING if state.living else 0) | (FLAG_BOOSTING if state.boosting else 0)
+    return (flags, quantize_position(state.x), quantize_position(state.y), quantize_angle(state.direction),
+            quantize_boost(state.boost_level))
+
+
+def encode_json(snapshot, baseline=None) -> bytes:
+    if baseline is None:
+        data = snapshot.get_encoded()
+    else:
+        old_states = {p.slot: p for p in baseline.players}
+        players = []
+        for state in snapshot.players:
+            old = old_states.get(state.slot)
+            changes = {
+                name: getattr(state, field) for field, name in JSON_FIELDS
+                if old is None or getattr(old, field) != getattr(state, field)
+            }
+            if changes:
+                changes['id'] = state.id
+                players.append(changes)
+        data = {'frames': snapshot.frames, 'baseline': baseline.frames, 'players': players}
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def encode_binary(snapshot, baseline=None) -> bytes:
+    if baseline is None:
+        buf = bytearray(FRAME_HEADER.size + FRAME_PLAYER.size * len(snapshot.players))
+        FRAME_HEADER.pack_into(buf, 0, FULL_FRAME, snapshot.frames & 0xFFFFFFFF, len(snapshot.players))
+        offset = FRAME_HEADER.size
+        for state in snapshot.players:
+            FRAME_PLAYER.pack_into(buf, offset, state.slot, *quantize(state))
+            offset += FRAME_PLAYER.size
+        return bytes(buf)
+
+    old_records = {p.slot: quantize(p) for p in baseline.players}
+    parts = []
+    count = 0
+    for state in snapshot.players:
+        record = quantize(state)
+        old = old_records.get(state.slot)
+        mask = 0
+        fields = []
+        for i, value in enumerate(record):
+            if old is None or old[i] != value:
+                mask |= 1 << i
+                fields.append(DELTA_FIELDS[i].pack(value))
+        if mask:
+            count += 1
+            parts.append(DELTA_PLAYER.pack(state.slot, mask))
+            parts.extend(fields)
+    header = DELTA_HEADER.pack(DELTA_FRAME, snapshot.frames & 0xFFFFFFFF, baseline.frames & 0xFFFFFFFF, count)
+    return header + b''.join(parts)
+
+
+ENCODERS = {
+    JSON: encode_json,
+    BINARY: encode_binary,
+}
+
+
+def encode(snapshot, fmt: str, baseline=None) -> bytes:
+    """
+    Encode a snapshot in the given wire format.
+    :param snapshot: the snapshot to send
+    :param fmt: one of FORMATS
+    :param baseline: a snapshot the client has acknowledged, or None to send a full keyframe
+    :return:
+    """
+    return ENCODERS[fmt](snapshot, baseline)
@@ -0,0 +1,319 @@
+"""
+A RoomCluster backend that simulates its games in a worker process instead of a thread, so that clusters are not all
+sharing one core under the GIL.
+
+The web process only holds lightweight proxies of each game. Setup and input flow to the worker as commands over a
+pipe. The worker writes the snapshot each game publishes into a SnapshotRing in shared memory, and the proxies read it
+from there when the broadcaster asks for it.
+"""
+import atexit
+import logging
+import multiprocessing
+
+import tornado.ioloop
+
+import game
+import snapshotring
+import threadmanager
+import util
+
+log = logging.getLogger(__name__)
+
+
+class RemotePlayer:
+    """
+    The web process' view of a player that lives in a worker process.
+    """
+
+    def __init__(self, player_id: str, team, slot: int, bot=False):
+        self.id = player_id
+        self.team: RemoteTeam = team
+        self.slot = slot
+        self.ready = bot
+        self.bot = bot
+
+    def __repr__(self):
+        return 'RemotePlayer(id={}, team={})'.format(self.id, self.team.id)
+
+    def set_input(self, rotation):
+        self.team.game.cluster.queue_input(self.team.game.id, self.id, rotation)
+
+
+class RemoteTeam:
+
+    def __init__(self, game, team_id: str):
+        self.game: RemoteGameInstance = game
+        self.id = team_id
+        self.players = []
+
+    def __repr__(self):
+        return 'RemoteTeam(id={}, playercount={})'.format(self.id, len(self.players))
+
+    def __iter__(self):
+        for p in self.players:
+            yield p
+
+    def create_player(self, bot=False) -> RemotePlayer:
+        player = RemotePlayer(util.random_string(game.PLAYER_ID_LENGTH), self, self.game.allocate_slot(), bot)
+        self.game.send('create_player', self.id, player.id, bot)
+        self.players.append(player)
+        return player
+
+
+class RemoteGameInstance:
+    """
+    Stands in for a GameInstance that is simulated by a ProcessRoomCluster. Ids are generated here so that setup never
+    has to wait on the worker.
+    """
+
+    def __init__(self, cluster, g_id, row, generation):
+        self.cluster: ProcessRoomCluster = cluster
+        self.id = g_id
+        self.row = row  # Where the worker writes our snapshots in the cluster's SnapshotRing
+        self.generation = generation  # Tells our entries apart from those of earlier games in the same row
+        self.teams = []
+        self.slot_count = 0
+        self.initialized = False
+        self._snapshot = game.Snapshot(0, (), (), False)
+        self._snapshot_sequence = 0
+
+    def __repr__(self):
+        return 'RemoteGameInstance({})'.format(self.id)
+
+    def send(self, command, *args):
+        self.cluster.send(command, self.id, *args)
+
+    @property
+    def players(self):
+        for t in self.teams:
+            for p in t:
+                yield p
+
+    def player_with_id(self, p_id):
+        for p in self.players:
+            if p.id == p_id:
+                return p
+        return None
+
+    @property
+    def snapshot(self) -> game.Snapshot:
+        """
+        The newest snapshot the worker has published. It is only rebuilt when the worker has written a new one.
+        """
+        sequence, generation, frames, game_flags, records = self.cluster.ring.read(self.row)
+        if generation == self.generation and sequence != self._snapshot_sequence:
+            self._snapshot = game.Snapshot(frames, tuple(
+                game.PlayerState(p.slot, p.id, p.team.id, bool(flags & snapshotring.FLAG_LIVING), x, y, direction,
+                                 bool(flags & snapshotring.FLAG_BOOSTING), boost_level)
+                for p, (x, y, direction, boost_level, flags) in zip(self.players, records)
+            ), (), bool(game_flags & snapshotring.FLAG_FINISHED))
+            self._snapshot_sequence = sequence
+        return self._snapshot
+
+    def allocate_slot(self) -> int:
+        slot = self.slot_count
+        self.slot_count += 1
+        return slot
+
+    def players_ready(self):
+        return all(p.ready for p in self.players)
+
+    def create_team(self) -> RemoteTeam:
+        team = RemoteTeam(self, util.random_string(game.PLAYER_ID_LENGTH))
+        self.send('create_team', team.id)
+        self.teams.append(team)
+        return team
+
+    def init(self):
+        self.send('init')
+        self.initialized = True
+
+
+# The scheduling statistics a worker shares with the web process, in the order they are stored
+STATS = ('ticks', 'overruns', 'dropped_ticks', 'last_tick_time', 'mean_tick_time', 'mean_physics_time', 'mean_jitter',
+         'max_jitter', 'pooled_games')
+
+
+class ClusterWorker(threadmanager.RoomCluster):
+    """
+    The RoomCluster that runs inside a worker process. Commands are applied between ticks, and new snapshots are
+    written to the shared ring after each tick.
+    """
+
+    def __init__(self, commands, ring_name, stats, games_limit, update_period):
+        super().__init__(games_limit, update_period)
+        self.commands = commands
+        self.stats = stats
+        self.ring = snapshotring.SnapshotRing(games_limit, name=ring_name)
+        self.registry = {}
+        self.rows = {}  # game id -> (row, generation)
+        self.written = {}
+
+    def tick(self):
+        while self.commands.poll():
+            command, g_id, *args = self.commands.recv()
+            getattr(self, 'do_' + command)(g_id, *args)
+        super().tick()
+        for instance in self.games:
+            if self.written.get(instance.id) is not instance.snapshot:
+                self.ring.write(*self.rows[instance.id], instance.snapshot)
+                self.written[instance.id] = instance.snapshot
+        for i, name in enumerate(STATS):
+            self.stats[i] = getattr(self, name)
+
+    def do_create_game(self, g_id, row, generation, player_count):
+        self.registry[g_id] = self.create_instance(g_id, player_count)
+        self.rows[g_id] = row, generation
+
+    def do_remove_game(self, g_id):
+        instance = self.registry.pop(g_id)
+        self.games.remove(instance)
+        del self.rows[g_id]
+        self.written.pop(g_id, None)
+        self.pool.recycle(instance)
+
+    def do_create_team(self, g_id, team_id):
+        self.registry[g_id].create_team(team_id)
+
+    def do_create_player(self, g_id, team_id, player_id, bot):
+        for team in self.registry[g_id].teams:
+            if team.id == team_id:
+                team.create_player(player_id, bot)
+
+    def do_init(self, g_id):
+        self.registry[g_id].init()
+
+    def do_set_inputs(self, g_id, inputs):
+        instance = self.registry.get(g_id)
+        if instance is None:
+            return  # Removed while the inputs were on their way
+        for player_id, rotation in inputs.items():
+            instance.player_with_id(player_id).set_input(rotation)
+
+
+def run_worker(commands, ring_name, stats, games_limit, update_period):
+    ClusterWorker(commands, ring_name, stats, games_limit, update_period).run()
+
+
+def _shared_stat(name):
+    index = STATS.index(name)
+    return property(lambda self: self._stats[index], doc='{} as last reported by the worker'.format(name))
+
+
+class ProcessRoomCluster:
+    """
+    A drop-in replacement for RoomCluster that runs its games in a separate process. Games cannot be migrated out of
+    a worker, since their pymunk spaces live there.
+    """
+
+    supports_migration = False
+
+    ticks = _shared_stat('ticks')
+    overruns = _shared_stat('overruns')
+    dropped_ticks = _shared_stat('dropped_ticks')
+    last_tick_time = _shared_stat('last_tick_time')
+    mean_tick_time = _shared_stat('mean_tick_time')
+    mean_physics_time = _shared_stat('mean_physics_time')
+    mean_jitter = _shared_stat('mean_jitter')
+    max_jitter = _shared_stat('max_jitter')
+    pooled_games = _shared_stat('pooled_games')
+
+    def __init__(self, games_limit, update_period):
+        self.games = []
+        self.games_limit = games_limit
+        self.update_period = update_period
+
+        self.ring = snapshotring.SnapshotRing(games_limit)
+        atexit.register(self.ring.destroy)
+        self._free_rows = list(range(games_limit))
+        self._generations = 0
+        self._inputs = {}  # game id -> {player id: rotation}, the newest input of each player since the last flush
+        self._flush_scheduled = False
+
+        context = multiprocessing.get_context('spawn')  # Forking a process that has threads running is unsafe
+        worker_commands, self._commands = context.Pipe(duplex=False)
+        self._stats = context.Array('d', len(STATS), lock=False)  # Each value is written by the worker alone
+        self.process = context.Process(target=run_worker, daemon=True,
+                                       args=(worker_commands, self.ring.name, self._stats, games_limit,
+                                             update_period))
+
+    def __repr__(self):
+        return 'ProcessRoomCluster({})'.format(self.process.pid)
+
+    def __iter__(self):
+        for g in self.games:
+            yield g
+
+    def start(self):
+        self.process.start()
+
+    def send(self, command, g_id, *args):
+        self._commands.send((command, g_id) + args)
+
+    def queue_input(self, g_id, player_id, rotation):
+        """
+        Hold on to a player's input until the next flush, so that the worker gets one command per game per tick
+        however many inputs come in.
+        """
+        self._inputs.setdefault(g_id, {})[player_id] = rotation
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            tornado.ioloop.IOLoop.current().call_later(self.update_period, self.flush_inputs)
+
+    def flush_inputs(self):
+        self._flush_scheduled = False
+        inputs, self._inputs = self._inputs, {}
+        for g_id, players in inputs.items():
+            self.send('set_inputs', g_id, players)
+
+    def body_count(self):
+        return sum(g.slot_count for g in self.games)
+
+    def get_metrics(self) -> dict:
+        """
+        The statistics the worker shares with us. Histograms and per-game timings stay in the worker, so only what the
+        snapshots tell us is reported per game.
+        """
+        stats = {name: getattr(self, name) for name in STATS}
+        stats.update({
+            'name': repr(self),
+            'games': len(self.games),
+            'bodies': self.body_count(),
+            'game_stats': [
+                {
+                    'id': g.id,
+                    'frames': g.snapshot.frames,
+                    'players': g.slot_count,
+                } for g in self.games
+            ],
+        })
+        return stats
+
+    def can_add_game(self):
+        """
+        Do we have enough space to add a new game?
+        :return:
+        """
+        return len(self.games) < self.games_limit
+
+    def create_instance(self, g_id, player_count=0) -> RemoteGameInstance:
+        """
+        Create a new game instance and return it. Raises a FullError if it could not.
+        :param player_count: how many players the game will have, so that the worker has trucks ready for them
+        :return:
+        """
+        if self.can_add_game():
+            self._generations += 1
+            game_instance = RemoteGameInstance(self, g_id, self._free_rows.pop(0), self._generations)
+            self.send('create_game', g_id, game_instance.row, game_instance.generation, player_count)
+            self.games.append(game_instance)
+            return game_instance
+        raise threadmanager.OutOfSpaceError
+
+    def remove_instance(self, game_instance):
+        """
+        Remove a game from this cluster. The worker puts it back in its pool before its next tick.
+        """
+        self.games.remove(game_instance)
+        self._free_rows.append(game_instance.row)
+        self.send('remove_game', game_instance.id)
@@ -0,0 +1,264 @@
+"""
+Matchmaking front for several nodes, which are game servers started with main.py. The router runs the lobby and the
+matchmaking queues. Each game it fills is created on the least loaded node, and the players' tokens name that node, so
+that their game page connects to it directly. Run it from this directory, like main.py:
+
+    python router.py --port 8080 --spawn 2
+
+--spawn starts that many nodes on the next ports of localhost. To use nodes started elsewhere, list them with --node,
+and give the router and every node the same TOKEN_SECRET and each node its own NODE_URL:
+
+    TOKEN_SECRET=s3cret NODE_URL=http://host-a:8080 python main.py
+    TOKEN_SECRET=s3cret python router.py --node http://host-a:8080 --node http://host-b:8080
+"""
+import argparse
+import atexit
+import binascii
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import tornado.ioloop
+import tornado.web
+from tornado import gen, httpclient
+
+import constants
+import main
+import matchmaking
+import sockets
+import tokens
+import views
+
+log = logging.getLogger(__name__)
+
+
+class Node:
+    """
+    A game server that the router creates games on. Its load is polled from its metrics endpoint.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.healthy = False  # Whether it answered the last time we asked it something
+        self.used = 0  # Games running on it
+        self.capacity = 0  # Most games it can run
+        self.pending = 0  # Games we asked it for that it has not created yet
+        self.games_created = 0
+
+    def __repr__(self):
+        return 'Node({})'.format(self.url)
+
+    @property
+    def load(self):
+        return (self.used + self.pending) / self.capacity if self.capacity else 1.0
+
+    def has_space(self):
+        return self.healthy and self.used + self.pending < self.capacity
+
+    def get_encoded(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'used': self.used,
+            'pending': self.pending,
+            'capacity': self.capacity,
+            'games_created': self.games_created,
+        }
+
+    @gen.coroutine
+    def poll(self):
+        """
+        Read how many games the node is running and can run.
+        """
+        try:
+            response = yield httpclient.AsyncHTTPClient().fetch(self.url + '/metrics?format=json',
+                                                                request_timeout=constants.ROUTER_REQUEST_TIMEOUT)
+            slots = json.loads(response.body.decode('utf-8'))['slots']
+        except Exception as e:
+            if self.healthy:
+                log.warning('%s stopped answering: %r', self, e)
+            self.healthy = False
+            return
+        if not self.healthy:
+            log.info('%s is up with %s/%s games', self, slots['used'], slots['capacity'])
+        self.used, self.capacity = slots['used'], slots['capacity']
+        self.healthy = True
+
+    def reserve(self):
+        """
+        Count a game we are about to ask for against our load right away, so that games picked before the node answers
+        are spread out.
+        """
+        self.pending += 1
+
+    @gen.coroutine
+    def create_game(self, gamemode, humans):
+        """
+        Ask the node to create and fill a game that was reserved.
+        :return: (game id, the ids of the humans' game players)
+        """
+        body, signature = tokens.sign_request({'gamemode': gamemode.code, 'humans': humans})
+        try:
+            response = yield httpclient.AsyncHTTPClient().fetch(self.url + '/internal/games', method='POST', body=body,
+                                                                headers={tokens.SIGNATURE_HEADER: signature},
+                                                                request_timeout=constants.ROUTER_REQUEST_TIMEOUT)
+        finally:
+            self.pending -= 1
+        data = json.loads(response.body.decode('utf-8'))
+        self.used += 1  # Until the next poll tells us otherwise
+        self.games_created += 1
+        return data['game'], data['players']
+
+
+class RoutedMatchmaker(matchmaking.Matchmaker):
+    """
+    A Matchmaker that creates its games on the router's nodes. Players are taken out of the queue as soon as a node is
+    picked for them, and put back at the front if the node fails to create their game.
+    """
+
+    def fill_game(self, backfill=False):
+        humans = self.humans_for_game(backfill)
+        if not humans:
+            return False
+        node = self.manager.pick_node()
+        if node is None:
+            log.info('%s could not create game because no node has space.', self)
+            return False
+        lobby_players = self.take_players(humans)
+        node.reserve()
+        tornado.ioloop.IOLoop.current().spawn_callback(self.create_remote_game, node, lobby_players)
+        return True
+
+    @gen.coroutine
+    def create_remote_game(self, node, lobby_players):
+        try:
+            game_id, player_ids = yield node.create_game(self.gamemode, len(lobby_players))
+        except Exception as e:
+            if isinstance(e, httpclient.HTTPError) and e.code == 503:
+                log.info('%s found %s full', self, node)
+                node.used = max(node.used, node.capacity)  # Until a poll says it has space again
+            else:
+                log.warning('%s could not create a game on %s: %r', self, node, e)
+                node.healthy = False  # Until it answers a poll again
+            self.requeue(lobby_players)
+            return
+        log.debug('created game with id %s on %s', game_id, node)
+        self.place(lobby_players, [tokens.issue(game_id, p_id, node.url) for p_id in player_ids])
+
+    def requeue(self, lobby_players):
+        """
+        Put the players of a game that could not be created back at the front of every queue they were in, and try
+        another node.
+        """
+        lobby_players = [lob for lob in lobby_players if lob.socket.ws_connection is not None]
+        self.players.put_back(lobby_players)
+        for lob in lobby_players:
+            lob.release(self)
+        for mm in self.manager.mmers:
+            if mm is self or any(mm in lob.matchmakers for lob in lobby_players):
+                mm.notify_player_count()
+                mm.attempt_fill_game()  # On another node, if any has space
+
+
+class Router:
+    """
+    Stands in for the GameManager of a single server. It has the matchmakers, and the nodes have the games.
+    """
+
+    def __init__(self, gamemodes, node_urls):
+        self.gamemodes = gamemodes
+        self.nodes = [Node(url) for url in node_urls]
+        self.mmers = [RoutedMatchmaker(gm, self) for gm in gamemodes]
+        self.started = time.monotonic()
+
+        self._poller = tornado.ioloop.PeriodicCallback(self.poll_nodes, constants.ROUTER_POLL_PERIOD)
+
+    def init(self):
+        for mm in self.mmers:
+            mm.init()
+        self._poller.start()
+        tornado.ioloop.IOLoop.current().spawn_callback(self.poll_nodes)
+
+    def pick_node(self) -> Node:
+        """
+        :return: the least loaded node with space for a game, or None
+        """
+        available = [node for node in self.nodes if node.has_space()]
+        if not available:
+            return None
+        return min(available, key=lambda node: node.load)
+
+    @gen.coroutine
+    def poll_nodes(self):
+        yield [node.poll() for node in self.nodes]
+        for mm in self.mmers:
+            mm.attempt_fill_game()  # Players may have been waiting for space
+
+
+def spawn_nodes(count, first_port):
+    """
+    Start nodes on localhost, on consecutive ports. They are stopped when this process exits. Unless TOKEN_SECRET is
+    set, a secret is made up for them and for us.
+    :return: their URLs
+    """
+    if not constants.TOKEN_SECRET:
+        secret = binascii.hexlify(os.urandom(16)).decode('ascii')
+        tokens.SECRET = secret.encode('utf-8')
+    else:
+        secret = constants.TOKEN_SECRET
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    urls = []
+    for port in range(first_port, first_port + count):
+        url = 'http://localhost:{}'.format(port)
+        env = dict(os.environ, PORT=str(port), NODE_URL=url, TOKEN_SECRET=secret)
+        process = subprocess.Popen([sys.executable, 'main.py'], cwd=here, env=env)
+        atexit.register(process.terminate)
+        log.info('started node %s with pid %s', url, process.pid)
+        urls.append(url)
+    return urls
+
+
+def get_app(router):
+    return tornado.web.Application([
+
+        (r'/static/(.*)', tornado.web.StaticFileHandler, {'path': os.path.join(main.PATH, '../static')}),
+
+        (r'/', views.MatchmakingView, {'manager': router}),
+        (r'/game', views.GameView, {'manager': router}),
+
+        (r'/socket/matchmaking', sockets.LobbyPlayerConnection, {'manager': router}),
+
+        (r'/nodes', views.NodesView, {'router': router}),
+
+    ], template_path='../views')
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=constants.PORT)
+    parser.add_argument('--node', dest='nodes', action='append', default=[], metavar='URL', help='a node to use')
+    parser.add_argument('--spawn', type=int, default=0, help='how many nodes to start on localhost')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if constants.DEBUG_MODE else logging.INFO)
+    if not args.nodes and not args.spawn:
+        parser.error('no nodes, use --node or --spawn')
+    if args.nodes and not constants.TOKEN_SECRET:
+        parser.error('set TOKEN_SECRET to the secret the nodes were started with')
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Exit normally, so that spawned nodes are stopped
+    node_urls = args.nodes + spawn_nodes(args.spawn, args.port + 1)
+    router = Router(main.GAMEMODES, node_urls)
+    router.init()
+    get_app(router).listen(args.port)
+    log.info('router listening on port %s with nodes %s', args.port, node_urls)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,124 @@
+"""
+A fixed-layout ring of game snapshots in shared memory, so that a worker process can publish game state and the web
+process can read it without copying it through a pipe.
+
+The block holds one section per game row. Each section starts with the ring position of the newest entry (uint32),
+followed by `depth` entries laid out as:
+
+    header:  write sequence (uint32), game generation (uint32), frame number (uint32), player count (uint8),
+             game flags (uint8), padding
+    player:  x, y, direction, boost level (float32 each), flags (uint8), padding -- one per player slot
+    trailer: write sequence (uint32)
+
+The writer fills the header, then the players, then the trailer. A reader that sees the same sequence in the trailer
+and the header knows it did not race the writer. Rows are reused as games come and go, so each game has its own
+generation number and readers ignore entries written for an earlier one.
+"""
+import logging
+import struct
+from multiprocessing import shared_memory
+
+import constants
+
+log = logging.getLogger(__name__)
+
+POSITION = struct.Struct('<I')
+ENTRY_HEADER = struct.Struct('<IIIBB2x')
+ENTRY_PLAYER = struct.Struct('<ffffB3x')
+ENTRY_TRAILER = struct.Struct('<I')
+
+# Player flags
+FLAG_LIVING = 1
+FLAG_BOOSTING = 2
+
+# Game flags
+FLAG_FINISHED = 1
+
+
+class SnapshotRing:
+    """
+    One per cluster. The worker process writes rows with write(), the web process reads them with read().
+    """
+
+    def __init__(self, games, players_per_game=constants.MAX_PLAYERS_PER_GAME, depth=constants.SNAPSHOT_RING_DEPTH,
+                 name=None):
+        """
+        :param games: how many game rows to hold
+        :param players_per_game: how many player slots each row has
+        :param depth: how many entries each row keeps before it is overwritten
+        :param name: the name of an existing block to attach to, or None to create a new one
+        """
+        self.games = games
+        self.players_per_game = players_per_game
+        self.depth = depth
+        self.entry_size = ENTRY_HEADER.size + ENTRY_PLAYER.size * players_per_game + ENTRY_TRAILER.size
+        self.row_size = POSITION.size + depth * self.entry_size
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=games * self.row_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self._sequences = [0] * games
+
+    def __repr__(self):
+        return 'SnapshotRing({})'.format(self.name)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _entry_offset(self, row, position):
+        return row * self.row_size + POSITION.size + position * self.entry_size
+
+    def write(self, row, generation, snapshot):
+        """
+        Write a snapshot into the next entry of a row, then make it the newest one.
+        """
+        players = snapshot.players[:self.players_per_game]
+        sequence = self._sequences[row] = (self._sequences[row] + 1) & 0xFFFFFFFF
+        position = (POSITION.unpack_from(self.buf, row * self.row_size)[0] + 1) % self.depth
+        offset = self._entry_offset(row, position)
+
+        ENTRY_HEADER.pack_into(self.buf, offset, sequence, generation, snapshot.frames & 0xFFFFFFFF, len(players),
+                               FLAG_FINISHED if snapshot.finished else 0)
+        offset += ENTRY_HEADER.size
+        for p in players:
+            flags = (FLAG_LIVING if p.living else 0) | (FLAG_BOOSTING if p.boosting else 0)
+            ENTRY_PLAYER.pack_into(self.buf, offset, p.x, p.y, p.direction, p.boost_level, flags)
+            offset += ENTRY_PLAYER.size
+        ENTRY_TRAILER.pack_into(self.buf, self._entry_offset(row, position) + self.entry_size - ENTRY_TRAILER.size,
+                                sequence)
+
+        POSITION.pack_into(self.buf, row * self.row_size, position)
+
+    def read(self, row):
+        """
+        Read the newest entry of a row.
+        :return: a tuple of (sequence, generation, frame number, game flags, player records). Each record is (x, y,
+        direction, boost level, flags), in slot order.
+        """
+        while True:
+            position = POSITION.unpack_from(self.buf, row * self.row_size)[0]
+            offset = self._entry_offset(row, position)
+            entry = self.buf[offset:offset + self.entry_size]  # A view, not a copy
+
+            trailer, = ENTRY_TRAILER.unpack_from(entry, self.entry_size - ENTRY_TRAILER.size)
+            sequence, generation, frames, count, game_flags = ENTRY_HEADER.unpack_from(entry)
+            records = list(ENTRY_PLAYER.iter_unpack(entry[ENTRY_HEADER.size:
+                                                          ENTRY_HEADER.size + count * ENTRY_PLAYER.size]))
+            entry.release()
+            if ENTRY_HEADER.unpack_from(self.buf, offset)[0] == trailer == sequence:
+                return sequence, generation, frames, game_flags, records
+            log.debug('%s raced the writer on row %s, retrying', self, row)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def destroy(self):
+        """
+        Close and free the block. Only the process that created it should call this.
+        """
+        self.close()
+        self.shm.unlink()
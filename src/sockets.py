@@ -1,17 +1,18 @@
 import json
 import logging
 import enum
-
-import pymunk
+import math
+import time
 
 import game
 
-import tornado
-import tornado.ioloop
 from tornado import websocket
 
 import constants
 import matchmaking
+import protocol
+import tokens
+import util
 
 
 log = logging.getLogger(__name__)
@@ -36,7 +37,6 @@ class LobbyPlayerConnection(websocket.WebSocketHandler):
         self.manager = manager
         self.state = LobbyState.INITIAL
         self.gamemode = None
-        self.queue_notifier = None
 
     def open(self, *args, **kwargs):
         log.debug('client connected from IP %s', self.request.remote_ip)
@@ -44,22 +44,27 @@ class LobbyPlayerConnection(websocket.WebSocketHandler):
     def on_message(self, msg):
         if self.state == LobbyState.INITIAL:
 
+            # A comma separated list of gamemodes queues us for whichever of them has a game for us first
+            codes = msg.split(',')
+            by_code = {mmer.gamemode.code: mmer for mmer in self.manager.mmers}
             try:
-                self.mmer = [mmer for mmer in self.manager.mmers if mmer.gamemode.code == msg][0]
-                log.info('%s requests gamemode %s', self.request.remote_ip, msg)
-            except IndexError:
+                self.mmers = [by_code[code] for code in codes]
+                log.info('%s requests gamemodes %s', self.request.remote_ip, codes)
+            except KeyError:
                 log.warning('%s sent invalid gamemode %s', self.request.remote_ip, msg)
                 self.close(1002, 'Invalid gamemode')
                 return
 
-            self.lobby_player = matchmaking.LobbyPlayer(self, self.mmer.gamemode, constants.ID_LENGTH)
-            self.mmer.add_player(self.lobby_player)
+            self.lobby_player = matchmaking.LobbyPlayer(self, constants.ID_LENGTH)
             log.info('%s assigned id %s', self.request.remote_ip, self.lobby_player.id)
             self.write_message(self.lobby_player.id)
-
-            log.debug('starting queue length notification for %s', self.lobby_player.id)
-            self.queue_notifier = tornado.ioloop.PeriodicCallback(self.notify_player_count, 3000)
-            self.queue_notifier.start()
+            self.state = LobbyState.FINDING
+            for mmer in self.mmers:
+                mmer.subscribe(self)
+            for mmer in self.mmers:
+                if self.state != LobbyState.FINDING:
+                    break  # An earlier one found us a game
+                mmer.add_player(self.lobby_player)
 
         elif self.state == LobbyState.FINDING:
             pass
@@ -70,35 +75,63 @@ class LobbyPlayerConnection(websocket.WebSocketHandler):
         else:
             raise ValueError('Something went wrong with the state machine in LobbyPlayerConnection')
 
-    def notify_player_count(self):
-        count = self.mmer.player_count()
-        log.debug('notifying %s about player queue', self.lobby_player.id)
-        self.write_message(json.dumps({'count': count, 'enough': False}))
-
     def on_close(self):
-        pass
+        if self.state == LobbyState.FINDING:
+            for mmer in self.mmers:
+                mmer.unsubscribe(self)
+                mmer.remove_player(self.lobby_player)  # So that we are not put in a game
 
     def on_enough_players(self, token:str):
         log.debug('notifying %s about enough players', self.lobby_player.id)
+        for mmer in self.mmers:
+            mmer.unsubscribe(self)
         self.write_message(json.dumps({'count': 0, 'enough': True, 'token': token}))
-        self.queue_notifier.stop()
         self.state = LobbyState.FILLING
 
 
 class GamePlayerConnection(websocket.WebSocketHandler):
 
     # noinspection PyMethodOverriding
-    def initialize(self, manager, transmission_pd):
+    def initialize(self, manager):
         self.state = GameState.OPENING
         self.manager = manager
-        self.period = transmission_pd
         self.player_id = None
         self.game_inst = None
-        self.outputter = None
+        self.broadcaster = None
+        self.wire_format = protocol.JSON
+        self.delta = False
+        self.acked_frame = None
+        self.input_limiter = util.RateLimiter(constants.INPUT_RATE_LIMIT, constants.INPUT_BURST)
+        self.dropped_inputs = 0
+
+        # Flow control of frames. Only one frame is written at a time, so a slow link costs at most one frame of memory.
+        self.write_started = None  # When the frame being written was handed to Tornado, or None if it was flushed
+        self.pending_bytes = 0
+        self.last_send = 0.0
+        self.mean_flush_time = 0.0  # Moving average of how long frames take to flush
+        self.send_interval = 0.0  # Least time between frames, raised for links that cannot keep up
+        self.behind = False  # Whether we skipped a frame because one was still being written
+        self.dropped_frames = 0
 
     def on_message(self, msg):
 
-        data = json.loads(msg)
+        if self.state == GameState.GAME and not self.input_limiter.allow():
+            if not self.dropped_inputs:
+                log.warning('%s is sending input too fast, dropping some', self.player_id)
+            self.dropped_inputs += 1
+            return  # Before parsing, so that flooding costs us as little as possible
+
+        try:
+            data = json.loads(msg)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            if self.state == GameState.OPENING:
+                self.send_error(400)
+                log.warning('client %s did not send a JSON object', self.request.remote_ip)
+            else:
+                log.warning('%s sent invalid data', self.player_id)
+            return
 
         if self.state == GameState.OPENING:
             try:
@@ -108,18 +141,32 @@ class GamePlayerConnection(websocket.WebSocketHandler):
                 log.warning('client %s did not send a token', self.request.remote_ip)
                 return
             try:
-                g_id, self.player_id = self.manager.tokens[token]
+                g_id, self.player_id, _ = tokens.verify(token)
+                self.game_inst = self.manager.thread_man.get_game(g_id)
                 log.debug('client %s sent valid token %s', self.request.remote_ip, token)
+            except tokens.InvalidTokenError as e:
+                self.send_error(400)
+                log.warning('client %s sent invalid token %s: %s', self.request.remote_ip, token, e)
+                return
             except KeyError:
                 self.send_error(400)
-                log.warning('client %s sent invalid token %s', self.request.remote_ip, token)
+                log.warning('client %s sent a token for game %s, which is not here', self.request.remote_ip, g_id)
+                return
+            self.wire_format = data.get('format', protocol.JSON)
+            if self.wire_format not in protocol.FORMATS:
+                self.send_error(400)
+                log.warning('client %s requested invalid format %s', self.request.remote_ip, self.wire_format)
                 return
+            self.delta = bool(data.get('delta', False))
             log.debug('client %s is in game with id %s', self.player_id, g_id)
-            self.game_inst = self.manager.thread_man.get_game(g_id)
+            self.broadcaster = self.manager.broadcasters[g_id]
             self.player = self.game_inst.player_with_id(self.player_id)
+            initializer = self.manager.initializers.get(g_id)
 
             self.write_message(json.dumps({
                 'valid': True,
+                'format': self.wire_format,
+                'delta': self.delta,
                 'playerSize': 30,
                 'arena': {
                     'width': game.ARENA_WIDTH,
@@ -134,20 +181,25 @@ class GamePlayerConnection(websocket.WebSocketHandler):
                         'id': t.id,
                         'players': [p.id for p in t]
                     } for t in self.game_inst.teams
-                ]
+                ],
+                'slots': {p.id: p.slot for p in self.game_inst.players}
             }))
-            self.player.ready = True
-            self.outputter = tornado.ioloop.PeriodicCallback(self.game_loop, self.period)
-            self.outputter.start()
+            if initializer is not None:
+                initializer.on_player_ready(self.player)  # Starts the game if we were the last one
+            self.broadcaster.subscribe(self)
             self.state = GameState.GAME
 
         elif self.state == GameState.GAME:
             try:
-                mov_data = data['movement']
-                input_dir = pymunk.Vec2d(mov_data['x'], mov_data['y'])
-                log.debug('%s: %s (%sdeg)', self.player_id, input_dir, input_dir.angle_degrees)
-                self.player.rotation = input_dir.angle
-            except KeyError:
+                if data.get('ack') is not None:
+                    self.acked_frame = int(data['ack'])
+                if 'movement' in data:
+                    mov_data = data['movement']
+                    rotation = math.atan2(float(mov_data['y']), float(mov_data['x']))
+                    if not math.isfinite(rotation):
+                        raise ValueError
+                    self.player.set_input(rotation)  # Applied at the start of the next tick
+            except (KeyError, TypeError, ValueError):
                 log.warning('%s sent invalid data', self.player_id)
 
         elif self.state == GameState.CLOSING:
@@ -156,12 +208,56 @@ class GamePlayerConnection(websocket.WebSocketHandler):
         else:
             raise ValueError('Something went wrong with the state machine in GamePlayerConnection')
 
-    def on_close(self):
-        self.outputter.stop()
+    def check_origin(self, origin):
+        return True  # A router's pages send clients to us from another origin. Their signed token is what we check
 
-    def game_loop(self):
-        encoded_data = self.game_inst.get_encoded()
-        self.write_message(encoded_data)
+    def on_close(self):
+        self.state = GameState.CLOSING
+        if self.broadcaster is not None:
+            self.broadcaster.unsubscribe(self)
+
+    def wants_frame(self) -> bool:
+        """
+        Called by the game's broadcaster before it encodes a frame for us. Frames are skipped while the previous one is
+        still being written, and when they come faster than our link has been able to take them.
+        """
+        now = time.monotonic()
+        if self.write_started is not None:
+            if now - self.write_started > constants.SEND_STALL_TIMEOUT:
+                log.warning('%s has not taken a frame in %ss, disconnecting', self.player_id, constants.SEND_STALL_TIMEOUT)
+                self.close(1008, 'Connection too slow')
+            self.behind = True
+            self.dropped_frames += 1
+            return False
+        if now - self.last_send < self.send_interval:
+            self.dropped_frames += 1
+            return False
+        return True
+
+    def send_frame(self, message: bytes, binary=False):
+        """
+        Called by the game's broadcaster with a frame that has already been encoded in our wire format.
+        """
+        self.write_started = self.last_send = time.monotonic()
+        self.pending_bytes = len(message)
+        future = self.write_message(message, binary=binary)
+        if future is None:
+            self.write_started = None  # The stream closed under us
+            self.pending_bytes = 0
+        else:
+            future.add_done_callback(self.on_frame_flushed)
+
+    def on_frame_flushed(self, future):
+        flush_time = time.monotonic() - self.write_started
+        self.write_started = None
+        self.pending_bytes = 0
+        if future.exception() is not None:
+            return  # Closed, on_close cleans up
+        self.mean_flush_time += (flush_time - self.mean_flush_time) / 8
+        self.send_interval = min(constants.MAX_FRAME_INTERVAL, self.mean_flush_time)
+        if self.behind and self.state == GameState.GAME and self.wants_frame():
+            self.behind = False
+            self.broadcaster.send_latest(self)  # Catch up with the newest frame rather than waiting for the next one
 
 
 log.setLevel(logging.DEBUG if constants.DEBUG_MODE else logging.WARN)
@@ -2,12 +2,14 @@
 The code that manages all the multiple threads and games per thread.
 """
 import asyncio
+import collections
 import logging
 import threading
 import time
 
 import constants
 import game
+import metrics
 import util
 
 log = logging.getLogger(__name__)
@@ -18,15 +20,17 @@ class ThreadsManager:
     Manages a group of threads and properly places games in each thread.
     """
 
-    def __init__(self, thread_limit, games_per_thread, update_period):
+    def __init__(self, thread_limit, games_per_thread, update_period, cluster_class=None):
         """
         :param thread_limit: most number of threads this can make 
         :param games_per_thread: how many games will we allow in each thread?
         :param update_period: delay between updates in seconds
+        :param cluster_class: the kind of cluster to run games in, RoomCluster by default
         """
         self.thread_limit = thread_limit
         self.games_per_thread = games_per_thread
         self.update_period = update_period
+        self.cluster_class = cluster_class or RoomCluster
 
         self.threads = []
         self.game_registry = {}
@@ -39,15 +43,25 @@ class ThreadsManager:
             for g in t:
                 yield g
 
-    def next_available_thread(self):
+    @staticmethod
+    def projected_load(thread, player_count=0):
         """
-        Find the next thread with an empty slot
+        Estimate the fraction of its tick budget a thread would use after adding a game with player_count players.
+        """
+        bodies = thread.body_count()
+        body_cost = thread.mean_tick_time / bodies if bodies and thread.mean_tick_time else constants.BODY_TICK_COST
+        return (bodies + player_count) * body_cost / thread.update_period
+
+    def next_available_thread(self, player_count=0):
+        """
+        Find the least loaded thread with an empty slot
+        :param player_count: how many players the game to be placed has
         :return:
         """
-        for th in self.threads:
-            if th.can_add_game():
-                return th
-        return None
+        available = [th for th in self.threads if th.can_add_game()]
+        if not available:
+            return None
+        return min(available, key=lambda th: self.projected_load(th, player_count))
 
     def can_create_thread(self):
         """
@@ -62,53 +76,93 @@ class ThreadsManager:
         :return:
         """
         log.debug('%s creating new thread', self)
-        thread = RoomCluster(self.games_per_thread, constants.GAME_UPDATE_PERIOD)
+        thread = self.cluster_class(self.games_per_thread, constants.GAME_UPDATE_PERIOD)
         thread.start()
         self.threads.append(thread)
         return thread
 
-    def next_thread_or_create(self):
+    def next_thread_or_create(self, player_count=0):
         """
-        Finds the next thread with an empty space. If there are none, checks if we can make a new thread. If we can,
-        creates one and returns it. Otherwise, returns None.
+        Finds the least loaded thread with an empty space. If there are none, or even that one would go over
+        CLUSTER_LOAD_TARGET, checks if we can make a new thread. If we can, creates one and returns it. Otherwise,
+        returns the best thread we found, or None.
         :return:
         """
-        log.debug('%s finding next thread')
-        thr = self.next_available_thread()
-        if thr is None and self.can_create_thread():
-            return self._create_thread()
+        log.debug('%s finding next thread', self)
+        thr = self.next_available_thread(player_count)
+        if thr is None or self.projected_load(thr, player_count) > constants.CLUSTER_LOAD_TARGET:
+            if self.can_create_thread():
+                return self._create_thread()
         return thr
 
-    def create_game(self):
+    def create_game(self, player_count=0):
         """
         Creates a game instance. Returns a tuple in the form of (game, thread). If there are no open slots, raises
         FullError.
+        :param player_count: how many players the game will have, used to place it on a thread that can afford it
         :return: 
         """
-        log.debug('%s attempting to create new game')
-        thr = self.next_thread_or_create()
+        log.debug('%s attempting to create new game', self)
+        thr = self.next_thread_or_create(player_count)
         if thr is None:
-            log.debug('%s could not create game, raising error')
+            log.debug('%s could not create game, raising error', self)
             raise OutOfSpaceError
         game_id = util.random_string(constants.ID_LENGTH)
-        game = thr.create_instance(game_id)
+        game = thr.create_instance(game_id, player_count)
         self.game_registry[game_id] = game
         return game_id, thr
 
     def get_game(self, id: str):
         return self.game_registry[id]
 
+    def is_migrating(self, id: str) -> bool:
+        game = self.game_registry[id]
+        return any(t.supports_migration and game in t.incoming for t in self.threads)
+
     def remove_game(self, id: str):
+        """
+        Remove a game from its thread and from the registry, freeing its slot. Raises a LookupError if the game is not
+        in any thread, which happens while it is being migrated.
+        """
+        if self.is_migrating(id):
+            raise LookupError('game {} is being migrated'.format(id))
         game = self.game_registry[id]
         for t in self.threads:
-            for g in t:
-                if g is game:
-                    del self.game_registry[id]
-                    break
-            else:
-                break
-        else:
-            raise LookupError('game_registry and actual contents do not match')
+            if game in t.games:
+                t.remove_instance(game)
+                del self.game_registry[id]
+                log.debug('%s removed game %s', self, id)
+                return
+        raise LookupError('game_registry and actual contents do not match')
+
+    def rebalance(self):
+        """
+        If a thread is over CLUSTER_OVERLOAD, move its biggest game that some other thread can take without going over
+        CLUSTER_LOAD_TARGET. At most one game is moved per call.
+        :return: the migrated game, or None
+        """
+        threads = [th for th in self.threads if th.supports_migration]
+        if len(threads) < 2:
+            return None
+        hot = max(threads, key=lambda th: th.mean_tick_time)
+        if hot.mean_tick_time <= hot.update_period * constants.CLUSTER_OVERLOAD:
+            return None
+
+        bodies = hot.body_count()
+        games = [g for g in hot if g.id in self.game_registry]  # Removed games stay in hot until its next tick
+        for instance in sorted(games, key=lambda g: g.slot_count, reverse=True):
+            # Our measurements are of the hot thread, so use its per-body cost for the game being moved
+            game_load = hot.mean_tick_time * instance.slot_count / bodies / hot.update_period if bodies else 0
+            targets = [th for th in threads if th is not hot and th.can_add_game()]
+            if not targets:
+                return None
+            target = min(targets, key=self.projected_load)
+            if self.projected_load(target) + game_load <= constants.CLUSTER_LOAD_TARGET:
+                log.info('%s moving %s from overloaded %s to %s', self, instance.id, hot, target)
+                hot.migrate(instance, target)
+                return instance
+        log.info('%s has nowhere to move games from overloaded %s', self, hot)
+        return None
 
 
 class RoomCluster(threading.Thread):
@@ -116,45 +170,188 @@ class RoomCluster(threading.Thread):
     A single thread. It may run multiple games.
     """
 
-    def __init__(self, games_limit, update_period):
-        super().__init__()
+    supports_migration = True
+
+    def __init__(self, games_limit, update_period, max_catchup_ticks=constants.MAX_CATCHUP_TICKS):
+        """
+        :param games_limit: how many games this cluster may run
+        :param update_period: simulated time per tick in seconds
+        :param max_catchup_ticks: most ticks to run back to back when behind schedule before dropping the backlog
+        """
+        super().__init__(daemon=True)  # Do not keep the server alive once the IOLoop is gone
         self.games = []
         self.games_limit = games_limit
         self.event_loop = asyncio.new_event_loop()
         self.update_period = update_period
+        self.max_catchup_ticks = max_catchup_ticks
+        self.pending = collections.deque()  # Functions to run on this thread between ticks
+        self.incoming = set()  # Games migrating to us that are not in self.games yet
+        self.outgoing = set()  # Games being removed that are still in self.games
+        self.pool = game.GamePool(games_limit)  # Finished games, kept to be set up again
+
+        # Scheduling statistics
+        self.ticks = 0
+        self.overruns = 0  # Ticks that took longer than update_period to run
+        self.dropped_ticks = 0  # Ticks skipped because we could not catch up
+        self.last_tick_time = 0.0
+        self.mean_tick_time = 0.0  # Moving average of last_tick_time
+        self.mean_jitter = 0.0  # Moving average of how late ticks start, in seconds
+        self.max_jitter = 0.0
+        self.last_physics_time = 0.0  # Part of last_tick_time spent in space.step
+        self.mean_physics_time = 0.0
+        self.tick_times = metrics.Histogram()
+        self.physics_times = metrics.Histogram()
+        self.python_times = metrics.Histogram()  # Everything in a tick other than space.step
 
     def __iter__(self):
         for g in self.games:
             yield g
 
+    @property
+    def pooled_games(self):
+        return len(self.pool)
+
+    def tick(self):
+        """
+        Run any pending work, then update every game once.
+        :return:
+        """
+        while self.pending:
+            self.pending.popleft()()
+        running = [g for g in self.games if g.running]
+        game.apply_inputs(running)  # What clients asked for since the last tick
+        game.steer_bots(running)  # One decision pass for every bot in the cluster
+        game.apply_forces(running, self.update_period)  # One pass over every body in the cluster
+        physics_time = 0.0
+        for instance in running:
+            # log.debug('running %s', instance)
+            instance.step(self.update_period)
+            physics_time += instance.last_physics_time
+        self.last_physics_time = physics_time
+
     def run(self):
+        """
+        Run ticks at a fixed timestep. Time owed is accumulated on the monotonic clock, and when we fall behind we run up
+        to max_catchup_ticks back to back so that games keep simulating at update_period instead of slowing down.
+        """
         log.debug('%s starting', self)
+        self.pool.prewarm(constants.GAME_POOL_PREWARM, constants.MAX_PLAYERS_PER_GAME)
+        previous = time.monotonic()
+        accumulator = 0.0
         while True:
-            loop_start = time.time()
-            for instance in self.games:
-                # log.debug('running %s', instance)
-                instance.update(self.update_period)
-            delay_time = self.update_period + loop_start - time.time()
-            try:
-                time.sleep(delay_time)  # The amount of time remaining in this loop
-            except ValueError:
-                log.warning('%s is lagging behind schedule!', self)
-                pass
+            now = time.monotonic()
+            accumulator += now - previous
+            previous = now
+
+            if accumulator >= self.update_period:
+                jitter = accumulator - self.update_period  # How late this tick is starting
+                self.mean_jitter += (jitter - self.mean_jitter) / 16
+                self.max_jitter = max(self.max_jitter, jitter)
+
+            steps = 0
+            while accumulator >= self.update_period and steps < self.max_catchup_ticks:
+                tick_start = time.monotonic()
+                self.tick()
+                self.last_tick_time = time.monotonic() - tick_start
+                self.mean_tick_time += (self.last_tick_time - self.mean_tick_time) / 16
+                self.mean_physics_time += (self.last_physics_time - self.mean_physics_time) / 16
+                self.tick_times.observe(self.last_tick_time)
+                self.physics_times.observe(self.last_physics_time)
+                self.python_times.observe(self.last_tick_time - self.last_physics_time)
+                if self.last_tick_time > self.update_period:
+                    self.overruns += 1
+                self.ticks += 1
+                accumulator -= self.update_period
+                steps += 1
+
+            if accumulator >= self.update_period:
+                dropped = int(accumulator // self.update_period)
+                self.dropped_ticks += dropped
+                accumulator -= dropped * self.update_period
+                log.warning('%s is lagging behind schedule! dropped %s ticks', self, dropped)
+
+            time.sleep(self.update_period - accumulator)  # The amount of time until the next tick is due
+
+    def body_count(self):
+        return sum(g.slot_count for g in self.games if g not in self.outgoing)
+
+    def get_metrics(self) -> dict:
+        """
+        Scheduling statistics, tick time histograms and per-game step timings, for the metrics endpoint.
+        """
+        return {
+            'name': self.name,
+            'games': len(self.games),
+            'bodies': self.body_count(),
+            'pooled_games': self.pooled_games,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'dropped_ticks': self.dropped_ticks,
+            'last_tick_time': self.last_tick_time,
+            'mean_tick_time': self.mean_tick_time,
+            'mean_physics_time': self.mean_physics_time,
+            'mean_jitter': self.mean_jitter,
+            'max_jitter': self.max_jitter,
+            'tick_times': self.tick_times.get_encoded(),
+            'physics_times': self.physics_times.get_encoded(),
+            'python_times': self.python_times.get_encoded(),
+            'game_stats': [
+                {
+                    'id': g.id,
+                    'frames': g.frames,
+                    'players': g.slot_count,
+                    'mean_step_time': g.mean_step_time,
+                    'mean_physics_time': g.mean_physics_time,
+                } for g in list(self.games)
+            ],
+        }
 
     def can_add_game(self):
         """
         Do we have enough space to add a new game?
         :return:
         """
-        return len(self.games) < self.games_limit
+        return len(self.games) - len(self.outgoing) + len(self.incoming) < self.games_limit
+
+    def remove_instance(self, game_instance):
+        """
+        Remove a game from this cluster and put it back in the pool. This happens between ticks, but its slot is free
+        for a new game right away.
+        """
+        self.outgoing.add(game_instance)
+
+        def remove():
+            self.outgoing.discard(game_instance)  # First, so can_add_game never subtracts it after it is gone
+            self.games.remove(game_instance)
+            self.pool.recycle(game_instance)
+
+        self.pending.append(remove)
+
+    def migrate(self, game_instance, target):
+        """
+        Move a game to another cluster. It is taken out of this cluster between our ticks, and added to the target
+        between its ticks, so neither thread ever sees it half-updated.
+        """
+        target.incoming.add(game_instance)
+
+        def hand_over():
+            self.games.remove(game_instance)
+            target.pending.append(receive)
+
+        def receive():
+            target.games.append(game_instance)
+            target.incoming.discard(game_instance)
+
+        self.pending.append(hand_over)
 
-    def create_instance(self, g_id) -> game.GameInstance:
+    def create_instance(self, g_id, player_count=0) -> game.GameInstance:
         """
-        Create a new game instance and return it. Raises a FullError if it could not.
+        Take a game instance from the pool and return it. Raises a FullError if it could not.
+        :param player_count: how many players the game will have
         :return:
         """
         if self.can_add_game():
-            game_instance = game.GameInstance(g_id)
+            game_instance = self.pool.take(g_id, player_count)
             self.games.append(game_instance)
             return game_instance
         raise OutOfSpaceError
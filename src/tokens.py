@@ -0,0 +1,117 @@
+"""
+Match tokens. A token names the game and player a client was matched into and the node that runs the game. Tokens are
+signed with TOKEN_SECRET, so that any server holding the secret can check one without having seen it issued, and they
+expire after TOKEN_TTL seconds.
+"""
+import base64
+import binascii
+import collections
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import constants
+
+SECRET = constants.TOKEN_SECRET.encode('utf-8') or os.urandom(32)  # A random secret only works within this process
+
+SIGNATURE_HEADER = 'X-Snowplows-Signature'  # Carries the signature of requests between a router and its nodes
+
+_seen_nonces = collections.OrderedDict()  # Nonces of requests accepted recently -> when they can be forgotten
+
+
+class InvalidTokenError(Exception):
+    """
+    Thrown when a token is malformed, is not signed with our secret or has expired.
+    """
+    pass
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def sign(data: bytes) -> str:
+    return _encode(hmac.new(SECRET, data, hashlib.sha256).digest())
+
+
+def check_signature(data: bytes, signature: str) -> bool:
+    return hmac.compare_digest(sign(data).encode('ascii'), signature.encode('utf-8'))
+
+
+def sign_request(data: dict):
+    """
+    Encode the body of a request between a router and a node. The time it was made and a nonce are added, so that it
+    cannot be replayed.
+    :return: (body, signature)
+    """
+    body = json.dumps(dict(data, issued=time.time(), nonce=_encode(os.urandom(12)))).encode('utf-8')
+    return body, sign(body)
+
+
+def verify_request(body: bytes, signature: str, now=None) -> dict:
+    """
+    Check a request made with sign_request. It is accepted once, within REQUEST_MAX_AGE seconds of being made.
+    :return: the data of the request
+    """
+    if not check_signature(body, signature):
+        raise InvalidTokenError('bad signature')
+    try:
+        data = json.loads(body.decode('utf-8'))
+        issued = float(data['issued'])
+        nonce = str(data['nonce'])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidTokenError('malformed request')
+
+    now = time.time() if now is None else now
+    while _seen_nonces and next(iter(_seen_nonces.values())) < now:
+        _seen_nonces.popitem(last=False)
+    if abs(now - issued) > constants.REQUEST_MAX_AGE:
+        raise InvalidTokenError('expired')
+    if nonce in _seen_nonces:
+        raise InvalidTokenError('replayed')
+    _seen_nonces[nonce] = issued + constants.REQUEST_MAX_AGE
+    return data
+
+
+def issue(game_id, player_id, node=constants.NODE_URL, ttl=constants.TOKEN_TTL) -> str:
+    """
+    Create the token a lobby player uses to join their game.
+    :param node: the URL of the node running the game, or an empty string for the one serving the page
+    """
+    payload = _encode(json.dumps([game_id, player_id, node, int(time.time() + ttl)]).encode('utf-8'))
+    return payload + '.' + sign(payload.encode('ascii'))
+
+
+def decode(token):
+    """
+    Read a token without checking it, as clients do, who do not have the secret.
+    :return: (game id, player id, node, expiry as a Unix time)
+    """
+    try:
+        game_id, player_id, node, expires = json.loads(_decode(token.partition('.')[0]).decode('utf-8'))
+    except (AttributeError, TypeError, ValueError, binascii.Error):
+        raise InvalidTokenError('malformed token')
+    return game_id, player_id, node, expires
+
+
+def verify(token, now=None):
+    """
+    Check a token's signature and expiry.
+    :param now: the Unix time to check expiry against, the current one by default
+    :return: (game id, player id, node)
+    """
+    if not isinstance(token, str):
+        raise InvalidTokenError('malformed token')
+    payload, _, signature = token.partition('.')
+    if not check_signature(payload.encode('utf-8'), signature):
+        raise InvalidTokenError('bad signature')
+    game_id, player_id, node, expires = decode(token)
+    if (time.time() if now is None else now) > expires:
+        raise InvalidTokenError('expired')
+    return game_id, player_id, node
@@ -3,6 +3,7 @@ Misc. functions
 """
 import random
 import string
+import time
 
 LETTERS = string.ascii_letters + string.digits + '-_'
 
@@ -20,3 +21,27 @@ def offset_box(cx, cy, length, width):
 def random_string(n, charset=LETTERS) -> str:
     return ''.join(random.choice(charset) for _ in range(n))
 
+
+class RateLimiter:
+    """
+    A token bucket. Allows `rate` events per second on average, and bursts of up to `burst` events.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        """
+        Take a token if there is one.
+        :return: whether the event is allowed
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
@@ -1,12 +1,32 @@
+import hmac
 import logging
+import threading
+
 import tornado.web
+from tornado import gen
 
 import constants
 import matchmaking
+import metrics
+import profiler
+import threadmanager
+import tokens
 
 
 log = logging.getLogger(__name__)
 
+ADMIN_TOKEN_HEADER = 'X-Snowplows-Admin-Token'
+
+
+def game_socket_url(node):
+    """
+    :param node: the URL of the node running a game, as found in its tokens
+    :return: the URL of its game socket, relative to the page if the node is the one serving it
+    """
+    if not node:
+        return 'socket/game'
+    return 'ws' + node[len('http'):] + '/socket/game'  # http -> ws, https -> wss
+
 
 class MatchmakingView(tornado.web.RequestHandler):
 
@@ -27,8 +47,134 @@ class GameView(tornado.web.RequestHandler):
 
     def post(self, *args, **kwargs):
         try:
-            self.render('game.html', socket_url='socket/game', token=str(self.request.arguments['token'][0], encoding='utf-8'))
+            token = str(self.request.arguments['token'][0], encoding='utf-8')
         except KeyError:
             self.send_error(400)
             log.warning('client %s did not send a token', self.request.remote_ip)
             return
+        try:
+            game_id, player_id, node = tokens.verify(token)
+        except tokens.InvalidTokenError as e:
+            self.send_error(400)
+            log.warning('client %s sent invalid token %s: %s', self.request.remote_ip, token, e)
+            return
+        self.render('game.html', socket_url=game_socket_url(node), token=token)
+
+
+class MetricsView(tornado.web.RequestHandler):
+    """
+    Runtime metrics, in the Prometheus text format, or as JSON with ?format=json
+    """
+
+    # noinspection PyMethodOverriding
+    def initialize(self, manager):
+        self.manager = manager
+
+    def get(self):
+        data = metrics.collect(self.manager)
+        if self.get_argument('format', 'text') == 'json':
+            self.write(data)
+        else:
+            self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.write(metrics.render_text(data))
+
+
+class ProfileView(tornado.web.RequestHandler):
+    """
+    Admin only. Samples a thread for a while and responds with its collapsed stacks, for a flame graph.
+
+    The ADMIN_TOKEN goes in the ADMIN_TOKEN_HEADER header, so that it does not end up in access logs. Without an
+    ADMIN_TOKEN, this endpoint does not exist.
+
+    Arguments: target (a cluster index as listed by /metrics, or "ioloop"), duration in seconds, and optionally interval
+    in seconds.
+    """
+
+    # noinspection PyMethodOverriding
+    def initialize(self, manager):
+        self.manager = manager
+
+    @gen.coroutine
+    def get(self):
+        if not constants.ADMIN_TOKEN:
+            raise tornado.web.HTTPError(404)
+        token = self.request.headers.get(ADMIN_TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode('utf-8'), constants.ADMIN_TOKEN.encode('utf-8')):
+            log.warning('%s tried to profile without a valid token', self.request.remote_ip)
+            raise tornado.web.HTTPError(403)
+
+        target = self.get_argument('target')
+        if target == 'ioloop':
+            thread_ident = threading.get_ident()
+        else:
+            try:
+                thread_ident = self.manager.thread_man.threads[int(target)].ident
+            except (ValueError, IndexError):
+                raise tornado.web.HTTPError(404, 'no cluster %s', target)
+            except AttributeError:
+                raise tornado.web.HTTPError(400, 'cluster %s does not run in this process', target)
+
+        try:
+            duration = float(self.get_argument('duration', '5'))
+            interval = float(self.get_argument('interval', str(constants.PROFILE_INTERVAL)))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not 0 < duration <= constants.PROFILE_MAX_DURATION or interval <= 0:
+            raise tornado.web.HTTPError(400)
+
+        try:
+            stacks = yield profiler.profile(thread_ident, duration, interval)
+        except profiler.ProfilerBusyError:
+            raise tornado.web.HTTPError(409, 'another profile is being taken')
+
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(profiler.collapse(stacks))
+
+
+class CreateGameView(tornado.web.RequestHandler):
+    """
+    For routers. Creates a game on this node and responds with its id and the ids of its human players, or 503 if we
+    are full.
+
+    The body is JSON with gamemode (a code) and humans (how many players are people), made with tokens.sign_request.
+    Each request is accepted once, within REQUEST_MAX_AGE seconds.
+    """
+
+    # noinspection PyMethodOverriding
+    def initialize(self, manager):
+        self.manager = manager
+
+    def post(self):
+        try:
+            data = tokens.verify_request(self.request.body, self.request.headers.get(tokens.SIGNATURE_HEADER, ''))
+        except tokens.InvalidTokenError as e:
+            log.warning('%s tried to create a game with an invalid request: %s', self.request.remote_ip, e)
+            raise tornado.web.HTTPError(403)
+
+        try:
+            gamemode = self.manager.gamemode_with_code(data['gamemode'])
+            humans = int(data['humans'])
+        except (KeyError, TypeError, ValueError):
+            raise tornado.web.HTTPError(400)
+        if not 0 < humans <= gamemode.total_players:
+            raise tornado.web.HTTPError(400)
+
+        try:
+            game_id, players = self.manager.create_game(gamemode, humans)
+        except threadmanager.OutOfSpaceError:
+            raise tornado.web.HTTPError(503, 'no space for another game')
+        log.info('created game %s for %s', game_id, self.request.remote_ip)
+        self.write({'game': game_id, 'players': [p.id for p in players]})
+
+
+class NodesView(tornado.web.RequestHandler):
+    """
+    The nodes of a router and their load, as JSON.
+    """
+
+    # noinspection PyMethodOverriding
+    def initialize(self, router):
+        self.router = router
+
+    def get(self):
+        self.write({'nodes': [node.get_encoded() for node in self.router.nodes]})
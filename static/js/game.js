@@ -5,6 +5,25 @@ const INPUT_PERIOD = 100;
 const ARENA_THICKNESS = 10;
 const EXTRA_SCALE_FACTOR = 0.75;
 
+// Wire format requested during the handshake, either 'json' or 'binary'
+const WIRE_FORMAT = 'binary';
+// Whether to ask for delta frames, and how many frames to keep as baselines for them
+const DELTA = true;
+const HISTORY_LENGTH = 32;  // Must match DELTA_HISTORY in src/constants.py
+
+// Binary frame layout, see src/protocol.py
+const FULL_FRAME = 0;
+const DELTA_FRAME = 1;
+const FRAME_HEADER_SIZE = 6;
+const FRAME_PLAYER_SIZE = 9;
+const DELTA_HEADER_SIZE = 10;
+const DELTA_PLAYER_SIZE = 2;
+const FLAG_LIVING = 1;
+const FLAG_BOOSTING = 2;
+const POSITION_SCALE = 4;
+const ANGLE_SCALE = 2 * Math.PI / 65536;
+const BOOST_SCALE = 255;
+
 const OPENING = 0;
 const GAME = 1;
 const CLOSING = 2;
@@ -185,6 +204,8 @@ function Player(team, id, isUser, size) {
 	this.isUser = isUser;
 	this.size = size;
 	this.living = true;
+	this.isBoosting = false;
+	this.boostLevel = 1;
 }
 
 Player.prototype.setTransform = function(x, y, direction) {
@@ -194,6 +215,13 @@ Player.prototype.setTransform = function(x, y, direction) {
 	return this;
 };
 
+Player.prototype.setState = function(state) {
+	this.living = state.living;
+	this.isBoosting = state.isBoosting;
+	this.boostLevel = state.boostLevel;
+	return this.setTransform(state.x, state.y, state.direction);
+};
+
 Player.prototype.getColor = function() {
 	return this.isUser ? SELF_COLOR : this.team.color;
 };
@@ -224,6 +252,10 @@ function Game() {
 	this.arena = {width: 0, height: 0};
 	this.player = null;
 	this.teams = {};
+	this.slots = [];
+	this.slotOf = {};
+	this.history = [];
+	this.lastFrame = null;
 }
 
 Game.prototype.initialize = function(data) {
@@ -246,12 +278,13 @@ Game.prototype.initialize = function(data) {
     	for (var j = teamData.players.length - 1; j >= 0; j--) {
     		var playerId = teamData.players[j];
     		console.log('creating player', playerId);
-    		if (playerId === data.player.id) {
+    		var player = team.createPlayer(playerId, playerId === data.player.id, data.playerSize);
+    		if (player.isUser) {
     			console.log('this.player');
-	    		this.player = team.createPlayer(playerId, true, data.playerSize);
-	    	} else {
-	    		team.createPlayer(playerId, false, data.playerSize);
+	    		this.player = player;
 	    	}
+	    	this.slots[data.slots[playerId]] = player;
+	    	this.slotOf[playerId] = data.slots[playerId];
     	}
     }
 
@@ -266,15 +299,121 @@ Game.prototype.forEachPlayer = function(cb) {
 	}
 };
 
+Game.prototype.storeFrame = function(frame, states) {
+	// Keep the frame around as a baseline for deltas, then show it
+	this.history[frame % HISTORY_LENGTH] = {frame: frame, states: states};
+	this.lastFrame = frame;
+	for (var slot = 0; slot < states.length; slot++) {
+		if (states[slot] !== undefined) {
+			this.slots[slot].setState(states[slot]);
+		}
+	}
+};
+
+Game.prototype.getBaseline = function(frame) {
+	// Returns a copy of the states at a stored frame, or null if we no longer have it
+	var entry = this.history[frame % HISTORY_LENGTH];
+	if (entry === undefined || entry.frame !== frame) {
+		return null;
+	}
+	return entry.states.map(function (state) {
+		return $.extend({}, state);
+	});
+};
+
 Game.prototype.update = function(data) {
 	var self = this;
-	data.teams.forEach(function (tData) {
-		var team = self.teams[tData.id];
-		tData.players.forEach(function (pData) {
-			var player = team.getPlayer(pData.id);
-			player.setTransform(pData.x, pData.y, pData.direction);
+	var states;
+	if (data.baseline === undefined) {
+		states = [];
+		data.teams.forEach(function (tData) {
+			tData.players.forEach(function (pData) {
+				states[self.slotOf[pData.id]] = {
+					living: pData.living,
+					x: pData.x,
+					y: pData.y,
+					direction: pData.direction,
+					isBoosting: pData.isBoosting,
+					boostLevel: pData.boostLevel
+				};
+			});
 		});
-	});
+	} else {
+		states = this.getBaseline(data.baseline);
+		if (states === null) {
+			return;  // The server sends a keyframe once it sees that our acks are stale
+		}
+		data.players.forEach(function (pData) {
+			var slot = self.slotOf[pData.id];
+			states[slot] = $.extend(states[slot] || {}, pData);
+			delete states[slot].id;
+		});
+	}
+	this.storeFrame(data.frames, states);
+};
+
+function setFlags(state, flags) {
+	state.living = (flags & FLAG_LIVING) !== 0;
+	state.isBoosting = (flags & FLAG_BOOSTING) !== 0;
+}
+
+Game.prototype.updateBinary = function(buffer) {
+	var view = new DataView(buffer);
+	var type = view.getUint8(0);
+	var frame = view.getUint32(1, true);
+	var states, count, offset, i;
+
+	if (type === FULL_FRAME) {
+		states = [];
+		count = view.getUint8(5);
+		offset = FRAME_HEADER_SIZE;
+		for (i = 0; i < count; i++, offset += FRAME_PLAYER_SIZE) {
+			var state = {
+				x: view.getInt16(offset + 2, true) / POSITION_SCALE,
+				y: view.getInt16(offset + 4, true) / POSITION_SCALE,
+				direction: view.getUint16(offset + 6, true) * ANGLE_SCALE,
+				boostLevel: view.getUint8(offset + 8) / BOOST_SCALE
+			};
+			setFlags(state, view.getUint8(offset + 1));
+			states[view.getUint8(offset)] = state;
+		}
+
+	} else {
+		states = this.getBaseline(view.getUint32(5, true));
+		if (states === null) {
+			return;  // The server sends a keyframe once it sees that our acks are stale
+		}
+		count = view.getUint8(9);
+		offset = DELTA_HEADER_SIZE;
+		for (i = 0; i < count; i++) {
+			var slot = view.getUint8(offset);
+			var mask = view.getUint8(offset + 1);
+			var changed = states[slot] = states[slot] || {};
+			offset += DELTA_PLAYER_SIZE;
+			if (mask & 1) {
+				setFlags(changed, view.getUint8(offset));
+				offset += 1;
+			}
+			if (mask & 2) {
+				changed.x = view.getInt16(offset, true) / POSITION_SCALE;
+				offset += 2;
+			}
+			if (mask & 4) {
+				changed.y = view.getInt16(offset, true) / POSITION_SCALE;
+				offset += 2;
+			}
+			if (mask & 8) {
+				changed.direction = view.getUint16(offset, true) * ANGLE_SCALE;
+				offset += 2;
+			}
+			if (mask & 16) {
+				changed.boostLevel = view.getUint8(offset) / BOOST_SCALE;
+				offset += 1;
+			}
+		}
+	}
+
+	this.storeFrame(frame, states);
 };
 
 $(function() {
@@ -292,6 +431,7 @@ $(function() {
 
 	console.log('opening socket');
 	game.socket = new WebSocket(websocketUrl($('head').data('socket-url')));
+	game.socket.binaryType = 'arraybuffer';
 	
 	async.parallel([
 
@@ -313,12 +453,26 @@ $(function() {
     	console.log('sending token', token);
     	game.socketstate = OPENING;
 		game.socket.send(JSON.stringify({
-			token: token
+			token: token,
+			format: WIRE_FORMAT,
+			delta: DELTA
 		})); 
 	});
 
+	game.socket.onclose = function(event) {
+		console.log('socket closed:', event.reason);
+		clearInterval(drawingTask);
+		clearInterval(inputTask);
+		game.socketstate = CLOSING;
+	};
+
 	game.socket.onmessage = function(event) {
 
+		if (event.data instanceof ArrayBuffer) {
+			game.updateBinary(event.data);
+			return;
+		}
+
 		var data = JSON.parse(event.data);
 		console.log('RECEIVED:', data);
 
@@ -351,6 +505,7 @@ $(function() {
 		        	console.log(inputManager.pos, pointOnScreen, playerPos);
 		        	game.socket.send(JSON.stringify({
 		        		movement: pointOnScreen.sub(playerPos),
+		        		ack: game.lastFrame,
 		        		events: []
 		        	}));
 		        }, INPUT_PERIOD);
@@ -3,6 +3,9 @@
 util = {};
 
 function websocketUrl(path) {
+	if (/^wss?:\/\//.test(path)) {
+		return path;  // Already absolute, a game on another node
+	}
 	return 'ws://' + $(location).attr('host') + '/' + path;
 }
 